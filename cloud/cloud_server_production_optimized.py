@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, g, has_request_context
 import requests
 import json
 import os
 import sys
 import secrets
 import base64
+import time
+import random
+import re
+import cProfile
+import math
+import hashlib
+import hmac
+import sqlite3
+import threading
+import ipaddress
+from urllib.parse import urlparse
 from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import logging
 import socket  # 添加socket模块用于DNS解析
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
 
 app = Flask(__name__)
 
@@ -62,6 +78,91 @@ app.config.update(
     PERMANENT_SESSION_LIFETIME=timedelta(minutes=5)
 )
 
+# ===== 请求性能分析（可选，默认关闭） =====
+# WOL_PROFILE_RATE: 随机采样比例(0~1)；WOL_PROFILE_TOKEN: 管理员令牌，请求头 X-WOL-Profile 携带时强制分析
+PROFILE_RATE = float(os.getenv('WOL_PROFILE_RATE', '0'))
+PROFILE_TOKEN = os.getenv('WOL_PROFILE_TOKEN')
+PROFILE_DIR = os.getenv('WOL_PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.getenv('WOL_PROFILE_MAX_FILES', '50'))
+# Python 3.12起cProfile基于进程级的 sys.monitoring，会同时记录其他线程（并发请求、后台线程）的调用；
+# 与其他请求重叠的分析文件名带 _mixed 标记
+PROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)
+_profile_lock = threading.Lock()
+_requests_in_flight = 0
+_requests_started = 0
+
+def track_request_start():
+    """统计进行中的请求（控制通道是常驻连接，不计入）"""
+    global _requests_in_flight, _requests_started
+    if request.path == '/relay/channel':
+        return
+    g.profile_tracked = True
+    with _profile_lock:
+        _requests_in_flight += 1
+        _requests_started += 1
+
+def track_request_end(exc=None):
+    global _requests_in_flight
+    if g.pop('profile_tracked', False):
+        with _profile_lock:
+            _requests_in_flight -= 1
+
+def start_request_profile():
+    """按采样比例或管理员请求头开启本次请求的cProfile"""
+    token = request.headers.get('X-WOL-Profile')
+    forced = bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+    if not forced and random.random() >= PROFILE_RATE:
+        return
+    
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 其他线程的分析器仍在运行
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+    with _profile_lock:
+        g.profile_overlap = (_requests_started, _requests_in_flight > 1)
+
+def finish_request_profile(response):
+    """保存pstats文件，文件名包含时间、路由、耗时和状态码"""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    
+    latency_ms = int((time.perf_counter() - g.pop('profile_started')) * 1000)
+    started_count, overlapped = g.pop('profile_overlap')
+    with _profile_lock:
+        overlapped = overlapped or _requests_started != started_count or _requests_in_flight > 1
+    mixed = '_mixed' if PROFILE_PROCESS_WIDE and overlapped else ''
+    route = request.url_rule.rule if request.url_rule else request.path
+    safe_route = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{request.method}_{safe_route}_{latency_ms}ms_{response.status_code}{mixed}_{os.urandom(2).hex()}.pstats"
+    
+    try:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        # 只保留最近的 PROFILE_MAX_FILES 个文件
+        profiles = sorted(
+            (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.pstats')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in profiles[:-PROFILE_MAX_FILES]:
+            os.remove(entry.path)
+        response.headers['X-WOL-Profile-File'] = filename
+    except OSError as e:
+        logger.error(f"保存性能分析文件失败: {e}")
+    return response
+
+# 未启用时不注册任何钩子，对请求零开销
+if PROFILE_RATE > 0 or PROFILE_TOKEN:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    app.before_request(track_request_start)
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(track_request_end)
+
 # 域名常量
 DOMAIN_NAME = config['bypass_domain']
 
@@ -115,48 +216,170 @@ def check_ip_bypass_auth(client_ip):
 
 
 # 从配置文件读取服务器配置
-UBUNTU_SERVER_HOST = config['ubuntu_server_host']
-UBUNTU_PORT = config['ubuntu_port']
-WINDOWS_MAC = config['windows_mac']
+# 旧版单中继配置；配置了 relays/hosts 时以多中继注册表为准
+UBUNTU_SERVER_HOST = config.get('ubuntu_server_host')  # 中继仅通过控制通道连接时可留空
+UBUNTU_PORT = config.get('ubuntu_port', 5000)
 
 # 存储文件路径
-USER_CREDENTIALS_FILE = 'user_credentials.json'
+USER_CREDENTIALS_FILE = 'user_credentials.json'  # 旧版JSON凭据文件，仅用于一次性迁移
+CREDENTIALS_DB_FILE = config.get('credentials_db', 'user_credentials.db')
 CHALLENGES_FILE = 'challenges.json'
 
 # 内存存储（临时挑战）
 CHALLENGES = {}
 SESSION_TIMEOUT = 300  # 5分钟会话超时
 
-def load_user_credentials():
-    """从文件加载用户凭据"""
-    try:
-        if os.path.exists(USER_CREDENTIALS_FILE):
-            with open(USER_CREDENTIALS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        logger.error(f"加载用户凭据失败: {e}")
-    return {}
-
-def save_user_credentials(credentials):
-    """保存用户凭据到文件"""
-    try:
-        # 创建备份
-        if os.path.exists(USER_CREDENTIALS_FILE):
-            backup_file = f"{USER_CREDENTIALS_FILE}.backup"
-            os.rename(USER_CREDENTIALS_FILE, backup_file)
+class CredentialStore:
+    """SQLite(WAL模式)凭据存储，每个用户可注册多个凭据
+    
+    每个线程使用独立连接，WAL模式下多个工作进程/线程可并发读取，
+    更新 last_used 等字段时只写单行。
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS credentials (
+            credential_id   TEXT PRIMARY KEY,
+            username        TEXT NOT NULL,
+            raw_id          TEXT NOT NULL,
+            type            TEXT NOT NULL DEFAULT 'public-key',
+            public_key      TEXT,
+            alg             INTEGER,
+            sign_count      INTEGER NOT NULL DEFAULT 0,
+            legacy_response TEXT,
+            registered_at   TEXT,
+            registered_ip   TEXT,
+            last_used       TEXT,
+            last_used_ip    TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_credentials_username ON credentials(username);
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _to_dict(row):
+        """转换为与旧JSON存储相同的字段名"""
+        credential = {
+            'id': row['credential_id'],
+            'rawId': row['raw_id'],
+            'type': row['type'],
+            'public_key': row['public_key'],
+            'alg': row['alg'],
+            'sign_count': row['sign_count'],
+            'registered_at': row['registered_at'],
+            'registered_ip': row['registered_ip'],
+            'last_used': row['last_used'],
+            'last_used_ip': row['last_used_ip']
+        }
+        if row['legacy_response']:
+            credential['response'] = json.loads(row['legacy_response'])
+        return credential
+    
+    def get_user_credentials(self, username):
+        rows = self._connection().execute(
+            'SELECT * FROM credentials WHERE username = ? ORDER BY registered_at', (username,)
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+    
+    def get_credential(self, username, credential_id):
+        row = self._connection().execute(
+            'SELECT * FROM credentials WHERE credential_id = ? AND username = ?', (credential_id, username)
+        ).fetchone()
+        return self._to_dict(row) if row else None
+    
+    def has_user(self, username):
+        return self._connection().execute(
+            'SELECT 1 FROM credentials WHERE username = ? LIMIT 1', (username,)
+        ).fetchone() is not None
+    
+    @staticmethod
+    def _insert_credential(conn, username, credential):
+        conn.execute(
+            '''INSERT INTO credentials (credential_id, username, raw_id, type, public_key, alg,
+                   sign_count, legacy_response, registered_at, registered_ip, last_used, last_used_ip)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (
+                credential['id'], username, credential['rawId'], credential.get('type', 'public-key'),
+                credential.get('public_key'), credential.get('alg'), credential.get('sign_count') or 0,
+                json.dumps(credential['response']) if credential.get('response') else None,
+                credential.get('registered_at'), credential.get('registered_ip'),
+                credential.get('last_used'), credential.get('last_used_ip')
+            )
+        )
+    
+    def add_credential(self, username, credential):
+        """新增凭据；凭据ID已存在时返回False"""
+        try:
+            with self._connection() as conn:
+                self._insert_credential(conn, username, credential)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+    
+    def record_use(self, credential_id, sign_count, client_ip):
+        """认证成功后单行更新签名计数和最后使用信息"""
+        with self._connection() as conn:
+            conn.execute(
+                'UPDATE credentials SET sign_count = ?, last_used = ?, last_used_ip = ? WHERE credential_id = ?',
+                (sign_count, datetime.now().isoformat(), client_ip, credential_id)
+            )
+    
+    def count_users(self):
+        return self._connection().execute('SELECT COUNT(DISTINCT username) FROM credentials').fetchone()[0]
+    
+    def migrate_from_json(self, json_file):
+        """一次性从旧版JSON文件导入凭据，完成后将JSON文件重命名为 .migrated
         
-        with open(USER_CREDENTIALS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(credentials, f, indent=2, ensure_ascii=False, default=str)
+        多个worker同时启动时，通过 BEGIN IMMEDIATE 写锁串行执行，后拿到锁的worker
+        会发现文件已被迁移而直接返回。
+        """
+        if not os.path.exists(json_file):
+            return 0
         
-        logger.info(f"用户凭据已保存，共 {len(credentials)} 个用户")
-        return True
-    except Exception as e:
-        logger.error(f"保存用户凭据失败: {e}")
-        # 恢复备份
-        backup_file = f"{USER_CREDENTIALS_FILE}.backup"
-        if os.path.exists(backup_file):
-            os.rename(backup_file, USER_CREDENTIALS_FILE)
-        return False
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not os.path.exists(json_file):
+                conn.rollback()
+                return 0
+            
+            with open(json_file, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            
+            imported = 0
+            for username, credential in legacy.items():
+                try:
+                    self._insert_credential(conn, username, credential)
+                    imported += 1
+                except sqlite3.IntegrityError:
+                    continue
+            
+            os.replace(json_file, f"{json_file}.migrated")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"迁移旧版凭据文件失败: {e}")
+            return 0
+        
+        logger.info(f"已从 {json_file} 迁移 {imported} 个凭据到 {self.path}")
+        return imported
+
+credential_store = CredentialStore(CREDENTIALS_DB_FILE)
+credential_store.migrate_from_json(USER_CREDENTIALS_FILE)
 
 def clean_expired_challenges():
     """清理过期的挑战"""
@@ -177,6 +400,310 @@ def clean_expired_challenges():
     except Exception as e:
         logger.error(f"清理过期挑战失败: {e}")
 
+# ===== WebAuthn 验证 =====
+class WebAuthnError(Exception):
+    """WebAuthn 注册/认证数据校验失败"""
+
+COSE_ALG_ES256 = -7
+COSE_ALG_RS256 = -257
+
+# 认证器数据标志位
+AUTH_FLAG_UP = 0x01  # 用户在场
+AUTH_FLAG_UV = 0x04  # 用户已验证
+AUTH_FLAG_AT = 0x40  # 包含凭据公钥
+
+# 已解析的公钥对象缓存: credential_id -> (alg, public_key)
+_public_key_cache = {}
+
+def b64url_decode(value):
+    """解码不带填充的base64url字符串"""
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+def _cbor_decode(data, offset=0):
+    """最小化CBOR解码（仅覆盖attestationObject和COSE密钥用到的类型）"""
+    if offset >= len(data):
+        raise WebAuthnError("CBOR数据被截断")
+    initial = data[offset]
+    major, info = initial >> 5, initial & 0x1f
+    offset += 1
+    
+    if info < 24:
+        value = info
+    elif info in (24, 25, 26, 27):
+        size = 1 << (info - 24)
+        if offset + size > len(data):
+            raise WebAuthnError("CBOR数据被截断")
+        value = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    else:
+        raise WebAuthnError("不支持的CBOR编码")
+    
+    if major == 0:
+        return value, offset
+    if major == 1:
+        return -1 - value, offset
+    if major in (2, 3):
+        chunk = data[offset:offset + value]
+        if len(chunk) != value:
+            raise WebAuthnError("CBOR数据被截断")
+        return (bytes(chunk) if major == 2 else chunk.decode('utf-8')), offset + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, offset = _cbor_decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        result = {}
+        for _ in range(value):
+            key, offset = _cbor_decode(data, offset)
+            result[key], offset = _cbor_decode(data, offset)
+        return result, offset
+    if major == 6:
+        return _cbor_decode(data, offset)
+    if major == 7 and value in (20, 21, 22):
+        return {20: False, 21: True, 22: None}[value], offset
+    raise WebAuthnError("不支持的CBOR类型")
+
+def parse_authenticator_data(auth_data):
+    """解析认证器数据: rpIdHash(32) + flags(1) + signCount(4) [+ 凭据数据]"""
+    if len(auth_data) < 37:
+        raise WebAuthnError("认证器数据长度无效")
+    
+    parsed = {
+        'rp_id_hash': auth_data[:32],
+        'flags': auth_data[32],
+        'sign_count': int.from_bytes(auth_data[33:37], 'big'),
+    }
+    
+    if parsed['flags'] & AUTH_FLAG_AT:
+        # aaguid(16) + 凭据ID长度(2) + 凭据ID + COSE公钥
+        if len(auth_data) < 55:
+            raise WebAuthnError("认证器数据长度无效")
+        cred_id_len = int.from_bytes(auth_data[53:55], 'big')
+        if len(auth_data) < 55 + cred_id_len:
+            raise WebAuthnError("认证器数据长度无效")
+        parsed['credential_id'] = auth_data[55:55 + cred_id_len]
+        parsed['cose_key_bytes'] = auth_data[55 + cred_id_len:]
+        # 扩展数据可能跟在公钥之后，只截取公钥部分
+        _, end = _cbor_decode(parsed['cose_key_bytes'])
+        parsed['cose_key_bytes'] = parsed['cose_key_bytes'][:end]
+    return parsed
+
+def load_cose_public_key(cose_key_bytes):
+    """将COSE公钥转换为可直接验签的密钥对象，返回 (alg, public_key)"""
+    cose_key, _ = _cbor_decode(cose_key_bytes)
+    if not isinstance(cose_key, dict):
+        raise WebAuthnError("COSE公钥格式无效")
+    alg = cose_key.get(3)
+    
+    if alg == COSE_ALG_ES256 and cose_key.get(1) == 2 and cose_key.get(-1) == 1:
+        public_key = ec.EllipticCurvePublicNumbers(
+            int.from_bytes(cose_key[-2], 'big'),
+            int.from_bytes(cose_key[-3], 'big'),
+            ec.SECP256R1()
+        ).public_key()
+    elif alg == COSE_ALG_RS256 and cose_key.get(1) == 3:
+        public_key = rsa.RSAPublicNumbers(
+            int.from_bytes(cose_key[-2], 'big'),
+            int.from_bytes(cose_key[-1], 'big')
+        ).public_key()
+    else:
+        raise WebAuthnError(f"不支持的公钥算法: {alg}")
+    return alg, public_key
+
+def get_cached_public_key(stored_credential):
+    """从缓存取公钥对象，未命中时解析一次并缓存"""
+    credential_id = stored_credential['id']
+    cached = _public_key_cache.get(credential_id)
+    if cached is not None:
+        return cached
+    
+    if stored_credential.get('public_key'):
+        cose_key_bytes = b64url_decode(stored_credential['public_key'])
+    else:
+        # 旧版本只保存了原始attestationObject，从中提取公钥
+        attestation, _ = _cbor_decode(b64url_decode(stored_credential['response']['attestationObject']))
+        cose_key_bytes = parse_authenticator_data(attestation['authData'])['cose_key_bytes']
+    
+    cached = _public_key_cache[credential_id] = load_cose_public_key(cose_key_bytes)
+    return cached
+
+def _verify_client_data(client_data_b64, expected_type, expected_challenge, rp_id):
+    """校验clientDataJSON的类型、挑战和来源，返回原始字节"""
+    client_data_bytes = b64url_decode(client_data_b64)
+    client_data = json.loads(client_data_bytes)
+    if not isinstance(client_data, dict):
+        raise WebAuthnError("clientData格式无效")
+    
+    if client_data.get('type') != expected_type:
+        raise WebAuthnError("clientData类型不匹配")
+    if not secrets.compare_digest(b64url_decode(client_data.get('challenge', '')), expected_challenge):
+        raise WebAuthnError("挑战不匹配")
+    
+    origin = urlparse(client_data.get('origin', ''))
+    if origin.scheme != 'https' or not (origin.hostname == rp_id or (origin.hostname or '').endswith('.' + rp_id)):
+        raise WebAuthnError(f"来源不匹配: {client_data.get('origin')}")
+    return client_data_bytes
+
+def verify_registration(credential, expected_challenge, rp_id):
+    """校验注册响应并提取公钥，返回需持久化的凭据字段
+    
+    凭据ID以认证器数据中的 credentialId 为准，客户端提交的 id/rawId 必须与之一致。
+    """
+    response = credential['response']
+    _verify_client_data(response['clientDataJSON'], 'webauthn.create', expected_challenge, rp_id)
+    
+    attestation, _ = _cbor_decode(b64url_decode(response['attestationObject']))
+    if not isinstance(attestation, dict) or not isinstance(attestation.get('authData'), bytes):
+        raise WebAuthnError("attestationObject格式无效")
+    auth_data = parse_authenticator_data(attestation['authData'])
+    
+    if not secrets.compare_digest(auth_data['rp_id_hash'], hashlib.sha256(rp_id.encode()).digest()):
+        raise WebAuthnError("rpIdHash不匹配")
+    if not auth_data['flags'] & AUTH_FLAG_UP:
+        raise WebAuthnError("未检测到用户在场")
+    if 'credential_id' not in auth_data:
+        raise WebAuthnError("注册响应缺少凭据公钥")
+    credential_id = b64url_encode(auth_data['credential_id'])
+    if credential['id'] != credential_id or credential['rawId'] != credential_id:
+        raise WebAuthnError("凭据ID不一致")
+    
+    # 只校验公钥可用；缓存仅由 get_cached_public_key 从已入库的凭据填充
+    alg, _ = load_cose_public_key(auth_data['cose_key_bytes'])
+    
+    return {
+        'credential_id': credential_id,
+        'public_key': b64url_encode(auth_data['cose_key_bytes']),
+        'alg': alg,
+        'sign_count': auth_data['sign_count'],
+    }
+
+def verify_assertion(credential, stored_credential, expected_challenge, rp_id):
+    """校验认证响应（签名、挑战、rpIdHash、标志位、计数器），返回新的签名计数"""
+    response = credential['response']
+    client_data_bytes = _verify_client_data(response['clientDataJSON'], 'webauthn.get', expected_challenge, rp_id)
+    
+    auth_data_bytes = b64url_decode(response['authenticatorData'])
+    auth_data = parse_authenticator_data(auth_data_bytes)
+    
+    if not secrets.compare_digest(auth_data['rp_id_hash'], hashlib.sha256(rp_id.encode()).digest()):
+        raise WebAuthnError("rpIdHash不匹配")
+    if not auth_data['flags'] & AUTH_FLAG_UP:
+        raise WebAuthnError("未检测到用户在场")
+    
+    alg, public_key = get_cached_public_key(stored_credential)
+    signed_data = auth_data_bytes + hashlib.sha256(client_data_bytes).digest()
+    signature = b64url_decode(response['signature'])
+    try:
+        if alg == COSE_ALG_ES256:
+            public_key.verify(signature, signed_data, ec.ECDSA(hashes.SHA256()))
+        else:
+            public_key.verify(signature, signed_data, padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise WebAuthnError("签名验证失败")
+    
+    # 计数器必须递增（双方都为0表示认证器不支持计数）
+    stored_count = stored_credential.get('sign_count') or 0
+    if (auth_data['sign_count'] or stored_count) and auth_data['sign_count'] <= stored_count:
+        raise WebAuthnError("签名计数器未递增，凭据可能被克隆")
+    return auth_data['sign_count']
+
+def get_rp_id():
+    """WebAuthn依赖方ID（使用实际域名）"""
+    host = request.host.split(':')[0]
+    if host in ['127.0.0.1', 'localhost']:
+        host = 'wol.gofoyi.shop'
+    return host
+
+# ===== 限流 =====
+RATE_LIMIT_MAX_KEYS = 10000  # 超过后淘汰最久未访问的计数
+RATE_LIMIT_IPV6_PREFIX = 64  # IPv6客户端按所在网段计数，防止轮换同一网段内的地址绕过限流
+
+class SlidingWindowLimiter:
+    """滑动窗口限流（用上一窗口计数按剩余比例加权近似），每个键只保存固定大小的状态"""
+    
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._windows = OrderedDict()  # key -> [窗口序号, 上一窗口计数, 当前窗口计数, 窗口长度]，按最近访问排序
+    
+    def hit(self, key, limit, window):
+        """记录一次请求，返回 (是否放行, 建议重试秒数)"""
+        now = time.time()
+        index = int(now // window)
+        
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or index - state[0] > 1:
+                state = [index, 0, 0, window]
+            elif index != state[0]:
+                state = [index, state[2], 0, window]
+            self._windows[key] = state
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+            
+            elapsed = (now % window) / window
+            if state[1] * (1 - elapsed) + state[2] >= limit:
+                return False, max(1, math.ceil(window - now % window))
+            
+            state[2] += 1
+            return True, 0
+
+rate_limiter = SlidingWindowLimiter()
+
+def rate_limit_client_ip():
+    """限流使用的客户端标识（IPv4地址或IPv6 /64网段）；经本机Nginx转发时取代理写入的地址"""
+    remote_addr = request.remote_addr or ''
+    if remote_addr in ('127.0.0.1', '::1'):
+        forwarded = request.headers.get('X-Real-IP') or request.headers.get('X-Forwarded-For', '').split(',')[-1]
+        if forwarded.strip():
+            remote_addr = forwarded.strip()
+    return rate_limit_subject(remote_addr)
+
+def rate_limit_subject(address):
+    """限流计数的主体：IPv4按单个地址，IPv6按 /64 网段"""
+    try:
+        ip = ipaddress.ip_address(address.split('%')[0])
+    except ValueError:
+        return address
+    if ip.version == 6 and ip.ipv4_mapped:
+        return str(ip.ipv4_mapped)
+    if ip.version == 6:
+        return str(ipaddress.ip_network(f"{ip}/{RATE_LIMIT_IPV6_PREFIX}", strict=False))
+    return str(ip)
+
+def rate_limit(per_ip, per_username=None, window=60):
+    """按客户端IP（及 用户名+IP）限流的装饰器，超限时在任何处理之前返回429
+    
+    用户名由客户端提供，单独按用户名计数会让任何人都能把真实用户锁在登录之外，
+    因此用户名限额只对同一IP生效。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            client_ip = rate_limit_client_ip()
+            checks = [(f"{request.endpoint}:ip:{client_ip}", per_ip)]
+            if per_username:
+                data = request.get_json(silent=True) or {}
+                username = str(data.get('username') or 'wol_user').strip()
+                checks.append((f"{request.endpoint}:user:{username}:{client_ip}", per_username))
+            
+            for key, limit in checks:
+                allowed, retry_after = rate_limiter.hit(key, limit, window)
+                if not allowed:
+                    logger.warning(f"请求过于频繁: {key}")
+                    response = jsonify({"error": "请求过于频繁，请稍后再试", "retry_after": retry_after})
+                    response.headers['Retry-After'] = str(retry_after)
+                    return response, 429
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 def require_biometric_auth(f):
     """需要生物识别认证或IP认证的装饰器"""
     @wraps(f)
@@ -282,6 +809,7 @@ def index():
     return render_template('biometric_auth.html')
 
 @app.route('/check_ip_bypass', methods=['POST'])
+@rate_limit(per_ip=10)
 def check_ip_bypass():
     """检查客户端IP是否可以跳过生物验证"""
     try:
@@ -354,6 +882,7 @@ def get_real_client_ip():
     return remote_addr
 
 @app.route('/quick_ip_check', methods=['GET'])
+@rate_limit(per_ip=20)
 def quick_ip_check():
     """快速IP检查（用于初步判断）"""
     try:
@@ -390,8 +919,22 @@ def quick_ip_check():
             "can_bypass": False
         })
 
+def has_biometric_session(username):
+    """当前会话是否为该用户未超时的生物识别登录（IP认证不算）"""
+    if not session.get('biometric_authenticated') or session.get('username') != username:
+        return False
+    try:
+        return datetime.now() - datetime.fromisoformat(session['auth_time']) <= timedelta(seconds=SESSION_TIMEOUT)
+    except (KeyError, ValueError):
+        return False
+
+def registration_allowed(username):
+    """首个凭据可直接注册；已有凭据的用户添加设备需先用已注册的设备登录"""
+    return not credential_store.has_user(username) or has_biometric_session(username)
+
 # 生物识别认证路由
 @app.route('/register/begin', methods=['POST'])
+@rate_limit(per_ip=5, per_username=3)
 def register_begin():
     """开始注册生物识别凭据"""
     try:
@@ -403,6 +946,11 @@ def register_begin():
         
         username = username.strip()
         
+        adding_device = credential_store.has_user(username)
+        if not registration_allowed(username):
+            logger.warning(f"拒绝为已注册用户添加设备（未登录）: {username} from {request.remote_addr}")
+            return jsonify({"error": "该用户已注册，添加新设备前请先使用已注册的设备登录"}), 403
+        
         challenge = secrets.token_bytes(32)
         challenge_b64 = base64.urlsafe_b64encode(challenge).decode('utf-8').rstrip('=')
         
@@ -412,9 +960,7 @@ def register_begin():
         }
         
         # 使用实际域名
-        host = request.host.split(':')[0]
-        if host in ['127.0.0.1', 'localhost']:
-            host = 'wol.gofoyi.shop'
+        host = get_rp_id()
         
         options = {
             "challenge": challenge_b64,
@@ -431,11 +977,17 @@ def register_begin():
                 {"alg": -7, "type": "public-key"},   # ES256
                 {"alg": -257, "type": "public-key"}  # RS256
             ],
-            "authenticatorSelection": {
-                "authenticatorAttachment": "platform",
-                "userVerification": "preferred",
-                "requireResidentKey": False
-            },
+            # 首次注册使用本机认证器；已登录添加设备时允许安全密钥或手机（跨设备）
+            "authenticatorSelection": dict(
+                {} if adding_device else {"authenticatorAttachment": "platform"},
+                userVerification="preferred",
+                requireResidentKey=False
+            ),
+            # 已注册的设备不再重复注册
+            "excludeCredentials": [
+                {"id": cred['rawId'], "type": "public-key"}
+                for cred in credential_store.get_user_credentials(username)
+            ],
             "timeout": 60000,
             "attestation": "none"
         }
@@ -448,6 +1000,7 @@ def register_begin():
         return jsonify({"error": f"注册初始化失败: {str(e)}"}), 500
 
 @app.route('/register/complete', methods=['POST'])
+@rate_limit(per_ip=5, per_username=3)
 def register_complete():
     """完成注册生物识别凭据"""
     try:
@@ -468,33 +1021,45 @@ def register_complete():
             del CHALLENGES[username]
             return jsonify({"error": "挑战已过期，请重新开始注册"}), 400
         
-        # 加载现有凭据
-        user_credentials = load_user_credentials()
+        # 开始注册后该用户可能已有凭据（并发的首次注册），需再次确认
+        if not registration_allowed(username):
+            del CHALLENGES[username]
+            logger.warning(f"拒绝为已注册用户添加设备（未登录）: {username} from {request.remote_addr}")
+            return jsonify({"error": "该用户已注册，添加新设备前请先使用已注册的设备登录"}), 403
+        
+        # 校验注册响应并解析公钥（仅在注册时解析一次）
+        try:
+            key_material = verify_registration(credential, challenge_data['challenge'], get_rp_id())
+        except (WebAuthnError, KeyError, ValueError) as e:
+            logger.warning(f"注册校验失败: {username} - {e}")
+            return jsonify({"error": f"注册校验失败: {str(e)}"}), 400
         
-        # 保存新凭据
-        user_credentials[username] = {
-            'id': credential['id'],
-            'rawId': credential['rawId'],
-            'response': credential['response'],
-            'type': credential['type'],
+        # 保存新凭据（同一用户可注册多个设备）
+        added = credential_store.add_credential(username, {
+            'id': key_material['credential_id'],
+            'rawId': key_material['credential_id'],
+            'type': credential.get('type', 'public-key'),
+            'public_key': key_material['public_key'],
+            'alg': key_material['alg'],
+            'sign_count': key_material['sign_count'],
             'registered_at': datetime.now().isoformat(),
             'registered_ip': request.remote_addr,
             'last_used': None
-        }
+        })
         
-        # 保存到文件
-        if save_user_credentials(user_credentials):
-            del CHALLENGES[username]
-            logger.info(f"生物识别注册成功: {username}")
-            return jsonify({"success": True, "message": "生物识别注册成功！"})
-        else:
-            return jsonify({"error": "保存凭据失败，请重试"}), 500
+        del CHALLENGES[username]
+        if not added:
+            return jsonify({"error": "该凭据已注册"}), 400
+        
+        logger.info(f"生物识别注册成功: {username} (凭据 {key_material['credential_id'][:16]}...)")
+        return jsonify({"success": True, "message": "生物识别注册成功！"})
         
     except Exception as e:
         logger.error(f"注册完成失败: {e}")
         return jsonify({"error": f"注册完成失败: {str(e)}"}), 500
 
 @app.route('/authenticate/begin', methods=['POST'])
+@rate_limit(per_ip=10, per_username=5)
 def authenticate_begin():
     """开始生物识别认证"""
     try:
@@ -506,9 +1071,9 @@ def authenticate_begin():
         username = username.strip()
         
         # 加载用户凭据
-        user_credentials = load_user_credentials()
+        user_credentials = credential_store.get_user_credentials(username)
         
-        if username not in user_credentials:
+        if not user_credentials:
             logger.warning(f"认证失败 - 用户未注册: {username}")
             return jsonify({"error": "用户未注册生物识别，请先注册"}), 400
         
@@ -521,9 +1086,7 @@ def authenticate_begin():
         }
         
         # 使用实际域名
-        host = request.host.split(':')[0]
-        if host in ['127.0.0.1', 'localhost']:
-            host = 'wol.gofoyi.shop'
+        host = get_rp_id()
         
         options = {
             "challenge": challenge_b64,
@@ -531,10 +1094,11 @@ def authenticate_begin():
             "rpId": host,
             "allowCredentials": [
                 {
-                    "id": user_credentials[username]['rawId'],
+                    "id": cred['rawId'],
                     "type": "public-key",
                     "transports": ["internal", "usb", "nfc", "ble"]
                 }
+                for cred in user_credentials
             ],
             "userVerification": "preferred"
         }
@@ -547,6 +1111,7 @@ def authenticate_begin():
         return jsonify({"error": f"认证初始化失败: {str(e)}"}), 500
 
 @app.route('/authenticate/complete', methods=['POST'])
+@rate_limit(per_ip=10, per_username=5)
 def authenticate_complete():
     """完成生物识别认证"""
     try:
@@ -562,26 +1127,26 @@ def authenticate_complete():
             logger.warning(f"认证完成时未找到挑战: {username}")
             return jsonify({"error": "未找到挑战，请重新开始认证"}), 400
         
-        # 加载用户凭据
-        user_credentials = load_user_credentials()
-        
-        if username not in user_credentials:
-            return jsonify({"error": "用户未注册"}), 400
-        
         challenge_data = CHALLENGES[username]
         if datetime.now() - challenge_data['timestamp'] > timedelta(minutes=5):
             del CHALLENGES[username]
             return jsonify({"error": "挑战已过期，请重新开始认证"}), 400
         
-        stored_credential = user_credentials[username]
-        if credential['id'] != stored_credential['id']:
+        # 按凭据ID查找（使用主键索引）
+        stored_credential = credential_store.get_credential(username, credential['id'])
+        if stored_credential is None:
             logger.warning(f"认证失败 - 凭据不匹配: {username}")
             return jsonify({"error": "认证失败，凭据不匹配"}), 400
         
-        # 更新最后使用时间
-        user_credentials[username]['last_used'] = datetime.now().isoformat()
-        user_credentials[username]['last_used_ip'] = request.remote_addr
-        save_user_credentials(user_credentials)
+        try:
+            sign_count = verify_assertion(credential, stored_credential, challenge_data['challenge'], get_rp_id())
+        except (WebAuthnError, KeyError, ValueError) as e:
+            del CHALLENGES[username]
+            logger.warning(f"认证失败 - 断言校验未通过: {username} - {e}")
+            return jsonify({"error": f"认证失败: {str(e)}"}), 400
+        
+        # 更新签名计数和最后使用时间
+        credential_store.record_use(stored_credential['id'], sign_count, request.remote_addr)
         
         # 设置会话
         session.permanent = True
@@ -631,14 +1196,15 @@ def user_info():
             })
         
         # 生物识别认证用户
-        user_credentials = load_user_credentials()
-        if username in user_credentials:
-            cred = user_credentials[username]
+        user_credentials = credential_store.get_user_credentials(username)
+        if user_credentials:
+            last_used = [cred['last_used'] for cred in user_credentials if cred.get('last_used')]
             return jsonify({
                 "username": username,
                 "auth_method": "生物识别",
-                "registered_at": cred.get('registered_at'),
-                "last_used": cred.get('last_used'),
+                "registered_at": user_credentials[0].get('registered_at'),
+                "last_used": max(last_used) if last_used else None,
+                "credentials": len(user_credentials),
                 "session_timeout": SESSION_TIMEOUT,
                 "client_ip": request.remote_addr
             })
@@ -649,51 +1215,648 @@ def user_info():
         logger.error(f"获取用户信息失败: {e}")
         return jsonify({"error": "获取用户信息失败"}), 500
 
+# ===== 中继控制通道 =====
+try:
+    from flask_sock import Sock  # 仅控制通道模式需要
+except ImportError:
+    Sock = None
+
+RELAY_CHANNEL_SECRET = config.get('relay_channel_secret')  # 仅单中继配置使用
+# 多中继时每个中继使用各自的密钥（relays.<名称>.secret），防止一个中继冒充另一个中继的ID
+_channel_relays = config['relays'] if config.get('relays') and config.get('hosts') else {'default': {}}
+RELAY_CHANNEL_SECRETS = {name: relay['secret'] for name, relay in _channel_relays.items() if relay.get('secret')}
+RELAY_CHANNEL_ENABLED = bool(RELAY_CHANNEL_SECRETS) or (len(_channel_relays) == 1 and bool(RELAY_CHANNEL_SECRET))
+if RELAY_CHANNEL_SECRET and len(_channel_relays) > 1:
+    logger.warning("多中继配置不使用全局 relay_channel_secret，请为每个中继设置 relays.<名称>.secret")
+RELAY_CHANNEL_MAX_SKEW = 60  # 握手时间戳允许的偏差（秒）
+RELAY_STATE_MAX_AGE = 30  # 推送的状态在该时间内视为最新（秒）
+# 断电或断网的中继不会发送关闭帧：服务端定期ping，未收到pong即断开；
+# 中继至少每个心跳间隔推送一次状态，超过空闲时间没有任何消息同样视为断开
+RELAY_CHANNEL_PING_INTERVAL = 15
+RELAY_CHANNEL_IDLE_TIMEOUT = 90
+
+class RelayUnavailable(Exception):
+    """中继既没有控制通道连接，也无法直连"""
+
+class RelayChannel:
+    """一个已认证的中继长连接，多个命令按ID复用同一连接"""
+    
+    def __init__(self, relay_id, ws):
+        self.relay_id = relay_id
+        self.ws = ws
+        self.connected_at = time.time()
+        self.state = None
+        self.closed = False
+        self._next_id = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+    
+    def send(self, message):
+        with self._send_lock:
+            self.ws.send(json.dumps(message))
+    
+    def request(self, method, path, json_body=None, params=None, headers=None, timeout=5):
+        """下发命令并等待中继响应，返回 (status_code, body)"""
+        waiter = {'event': threading.Event(), 'response': None}
+        with self._lock:
+            if self.closed:
+                raise RelayUnavailable(f"中继 {self.relay_id} 控制通道已断开")
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = waiter
+        
+        try:
+            self.send({
+                "type": "request",
+                "id": request_id,
+                "method": method,
+                "path": path,
+                "body": json_body,
+                "params": params,
+                "headers": headers
+            })
+            if not waiter['event'].wait(timeout):
+                raise RelayUnavailable(f"中继 {self.relay_id} 响应超时")
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        
+        if waiter['response'] is None:
+            raise RelayUnavailable(f"中继 {self.relay_id} 控制通道已断开")
+        return waiter['response'].get('status', 500), waiter['response'].get('body')
+    
+    def deliver(self, message):
+        """处理中继发来的消息：命令响应或状态推送"""
+        if message.get('type') == 'response':
+            with self._lock:
+                waiter = self._pending.get(message.get('id'))
+            if waiter is not None:
+                waiter['response'] = message
+                waiter['event'].set()
+        elif message.get('type') == 'state':
+            self.state = {"win_status": message.get('win_status'), "ts": message.get('ts'), "received_at": time.time()}
+    
+    def fresh_state(self):
+        if self.state and time.time() - self.state['received_at'] <= RELAY_STATE_MAX_AGE:
+            return self.state
+        return None
+    
+    def close(self):
+        """连接断开，唤醒所有等待中的请求"""
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+        for waiter in pending:
+            waiter['event'].set()
+
+relay_channels = {}
+relay_channels_lock = threading.Lock()
+_seen_nonces = {}
+_seen_nonces_lock = threading.Lock()
+
+def relay_channel_secret(relay_id):
+    """中继ID对应的握手密钥；只配置了一个中继时才接受全局 relay_channel_secret"""
+    if relay_id in RELAY_CHANNEL_SECRETS:
+        return RELAY_CHANNEL_SECRETS[relay_id]
+    if len(_channel_relays) == 1:
+        return RELAY_CHANNEL_SECRET
+    return None
+
+def sign_channel_message(secret, *parts):
+    """控制通道握手签名: HMAC-SHA256(密钥, 各字段以换行连接)"""
+    message = '\n'.join(str(part) for part in parts).encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def verify_relay_handshake(headers):
+    """校验中继握手签名、时间戳和一次性随机数，成功时返回中继ID"""
+    relay_id = headers.get('X-Relay-Id', '')
+    timestamp = headers.get('X-Relay-Timestamp', '')
+    nonce = headers.get('X-Relay-Nonce', '')
+    signature = headers.get('X-Relay-Signature', '')
+    
+    if not (relay_id and timestamp.isdigit() and nonce and signature):
+        return None
+    now = time.time()
+    if abs(now - int(timestamp)) > RELAY_CHANNEL_MAX_SKEW:
+        return None
+    secret = relay_channel_secret(relay_id)
+    if not secret or not hmac.compare_digest(signature, sign_channel_message(secret, relay_id, timestamp, nonce)):
+        return None
+    
+    # 防重放：清理过期随机数后检查是否已使用
+    with _seen_nonces_lock:
+        for seen, seen_at in list(_seen_nonces.items()):
+            if now - seen_at > RELAY_CHANNEL_MAX_SKEW * 2:
+                _seen_nonces.pop(seen, None)
+        if nonce in _seen_nonces:
+            return None
+        _seen_nonces[nonce] = now
+    return relay_id
+
+def get_relay_channel(relay_id=None):
+    with relay_channels_lock:
+        if relay_id is not None:
+            return relay_channels.get(relay_id)
+        return next(iter(relay_channels.values()), None)
+
+@app.before_request
+def authenticate_relay_channel():
+    """在WebSocket升级之前校验中继身份"""
+    if request.path != '/relay/channel':
+        return None
+    if not RELAY_CHANNEL_ENABLED:
+        return jsonify({"error": "控制通道未启用"}), 404
+    relay_id = verify_relay_handshake(request.headers)
+    if relay_id is None:
+        logger.warning(f"中继控制通道认证失败: {request.remote_addr}")
+        return jsonify({"error": "认证失败"}), 401
+    g.relay_id = relay_id
+    return None
+
+def relay_channel(ws):
+    """中继控制通道：握手后持续接收响应和状态推送"""
+    relay_id = g.relay_id
+    channel = RelayChannel(relay_id, ws)
+    channel.send({"type": "hello", "signature": sign_channel_message(
+        relay_channel_secret(relay_id), 'cloud', relay_id, request.headers['X-Relay-Nonce']
+    )})
+    
+    with relay_channels_lock:
+        previous = relay_channels.get(relay_id)
+        relay_channels[relay_id] = channel
+    if previous is not None:
+        previous.close()
+    relay_registry.mark_connected(relay_id)
+    logger.info(f"中继控制通道已连接: {relay_id} ({request.remote_addr})")
+    # 中继恢复连接，立即重放排队的唤醒请求
+    threading.Thread(target=replay_wake_queue, daemon=True).start()
+    
+    try:
+        while True:
+            raw = ws.receive(timeout=RELAY_CHANNEL_IDLE_TIMEOUT)
+            if raw is None:
+                logger.warning(f"中继 {relay_id} 控制通道超过 {RELAY_CHANNEL_IDLE_TIMEOUT} 秒无消息，断开")
+                break
+            try:
+                channel.deliver(json.loads(raw))
+            except ValueError:
+                logger.warning(f"中继 {relay_id} 发送了无效消息")
+    finally:
+        channel.close()
+        with relay_channels_lock:
+            replaced = relay_channels.get(relay_id) is not channel
+            if not replaced:
+                del relay_channels[relay_id]
+        if not replaced:
+            relay_registry.mark_disconnected(relay_id)
+        logger.info(f"中继控制通道已断开: {relay_id}")
+
+if RELAY_CHANNEL_ENABLED:
+    app.config.setdefault('SOCK_SERVER_OPTIONS', {'ping_interval': RELAY_CHANNEL_PING_INTERVAL})
+    if Sock is None:
+        logger.error("启用控制通道需要安装 flask-sock: pip3 install flask-sock")
+    else:
+        Sock(app).route('/relay/channel')(relay_channel)
+
+# ===== 多中继路由 =====
+RELAY_HEALTH_INTERVAL = config.get('relay_health_interval', 15)  # 后台健康检查间隔（秒）
+RELAY_HEALTH_ALPHA = 0.3  # 健康分数的指数滑动平均系数
+RELAY_FAILOVER_STATUSES = (502, 503, 504)
+
+class RelayRegistry:
+    """主机 -> 中继列表的注册表，维护每个中继的健康分数
+    
+    未配置 relays/hosts 时按旧版单中继配置（ubuntu_server_host + windows_mac）
+    生成名为 default 的中继和名为 windows 的主机。
+    """
+    
+    def __init__(self, cfg):
+        if cfg.get('relays') and cfg.get('hosts'):
+            self.relays = {name: dict(relay) for name, relay in cfg['relays'].items()}
+            self.hosts = {name: dict(host) for name, host in cfg['hosts'].items()}
+        else:
+            self.relays = {'default': {'host': UBUNTU_SERVER_HOST, 'port': UBUNTU_PORT}}
+            self.hosts = {'windows': {'mac': cfg['windows_mac'], 'relays': ['default']}}
+        
+        # 中继只控制自身配置的那一台Windows主机（睡眠、状态均不区分主机），不能被多个主机共用
+        owners = {}
+        for host_name, host in self.hosts.items():
+            unknown = [name for name in host['relays'] if name not in self.relays]
+            if unknown:
+                raise ValueError(f"主机 {host_name} 引用了未定义的中继: {unknown}")
+            for name in host['relays']:
+                if owners.setdefault(name, host_name) != host_name:
+                    raise ValueError(f"中继 {name} 同时被主机 {owners[name]} 和 {host_name} 引用，每个中继只能服务一台主机")
+        
+        self.default_host = next(iter(self.hosts))
+        self._lock = threading.Lock()
+        self._health = {
+            name: {'score': 1.0, 'latency': None, 'last_ok': None, 'last_failed': None, 'last_error': None, 'checked_at': None}
+            for name in self.relays
+        }
+    
+    def host_mac(self, host):
+        return self.hosts[host]['mac']
+    
+    def channel_for(self, relay_name):
+        """中继对应的控制通道；只配置了一个中继时任意已认证通道都属于它"""
+        channel = get_relay_channel(relay_name)
+        if channel is None and len(self.relays) == 1:
+            channel = get_relay_channel()
+        return channel
+    
+    def record(self, relay_name, ok, latency=None, error=None):
+        """记录一次请求或健康检查的结果"""
+        with self._lock:
+            health = self._health[relay_name]
+            health['score'] = (1 - RELAY_HEALTH_ALPHA) * health['score'] + RELAY_HEALTH_ALPHA * (1.0 if ok else 0.0)
+            health['checked_at'] = time.time()
+            if ok:
+                health['last_ok'] = health['checked_at']
+                if latency is not None:
+                    previous = health['latency']
+                    health['latency'] = latency if previous is None else (
+                        (1 - RELAY_HEALTH_ALPHA) * previous + RELAY_HEALTH_ALPHA * latency
+                    )
+            else:
+                health['last_failed'] = health['checked_at']
+                health['last_error'] = str(error) if error else 'unavailable'
+    
+    def _relay_name_for_channel(self, relay_id):
+        """控制通道的中继ID对应的注册表名称；只配置了一个中继时任意ID都属于它"""
+        if relay_id in self.relays:
+            return relay_id
+        if len(self.relays) == 1:
+            return next(iter(self.relays))
+        return None
+    
+    def mark_connected(self, relay_id):
+        """控制通道握手成功，视为一次成功的检查"""
+        name = self._relay_name_for_channel(relay_id)
+        if name is not None:
+            self.record(name, True)
+    
+    def mark_disconnected(self, relay_id):
+        """控制通道断开；没有直连地址的中继此时已不可达"""
+        name = self._relay_name_for_channel(relay_id)
+        if name is not None and not self.relays[name].get('host'):
+            self.record(name, False, error='控制通道已断开')
+    
+    def is_available(self, relay_name):
+        """最近一次检查或请求成功（从未检查过时视为可用）
+        
+        控制通道在线也以检查结果为准：半开的通道在请求超时后同样视为不可用。
+        """
+        with self._lock:
+            health = self._health[relay_name]
+            return health['last_failed'] is None or (health['last_ok'] or 0) >= health['last_failed']
+    
+    def host_available(self, host):
+        return any(self.is_available(name) for name in self.hosts[host]['relays'])
+    
+    def relays_for(self, host):
+        """按健康程度排序的中继列表（分数高、延迟低的优先）"""
+        with self._lock:
+            return sorted(
+                self.hosts[host]['relays'],
+                key=lambda name: (-round(self._health[name]['score'], 1), self._health[name]['latency'] or 0)
+            )
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: dict(self._health[name], connected=self.channel_for(name) is not None)
+                for name in self.relays
+            }
+
+relay_registry = RelayRegistry(config)
+DEFAULT_HOST = relay_registry.default_host
+
+# 直连模式复用HTTP连接
+_relay_http = requests.Session()
+_relay_fanout_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='relay-fanout')
+
+def _request_relay(relay_name, method, path, json_body=None, params=None, headers=None, timeout=5):
+    """向指定中继发送请求：优先走控制通道，没有通道时直连HTTP"""
+    channel = relay_registry.channel_for(relay_name)
+    if channel is not None:
+        return channel.request(method, path, json_body, params, headers, timeout)
+    
+    relay = relay_registry.relays[relay_name]
+    if not relay.get('host'):
+        raise RelayUnavailable(f"中继 {relay_name} 未连接控制通道")
+    
+    response = _relay_http.request(
+        method,
+        f"http://{relay['host']}:{relay.get('port', 5000)}{path}",
+        json=json_body,
+        params=params,
+        headers=headers,
+        timeout=timeout
+    )
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    return response.status_code, body
+
+def relay_request(method, path, json_body=None, params=None, headers=None, timeout=5, host=None, relay=None):
+    """按健康度选择中继发送请求，超时或不可达时在本次请求内切换到下一个中继
+    
+    返回 (status_code, body, relay_name)；指定 relay 时只发往该中继。
+    """
+    candidates = [relay] if relay else relay_registry.relays_for(host or DEFAULT_HOST)
+    last_error = None
+    
+    for relay_name in candidates:
+        started = time.time()
+        try:
+            status_code, body = _request_relay(relay_name, method, path, json_body, params, headers, timeout)
+        except (RelayUnavailable, requests.RequestException) as e:
+            relay_registry.record(relay_name, False, error=e)
+            last_error = e
+            logger.warning(f"中继 {relay_name} 请求失败，尝试下一个: {e}")
+            continue
+        
+        if status_code in RELAY_FAILOVER_STATUSES:
+            relay_registry.record(relay_name, False, error=f"HTTP {status_code}")
+            last_error = RelayUnavailable(f"中继 {relay_name} 返回 {status_code}")
+            continue
+        
+        relay_registry.record(relay_name, True, time.time() - started)
+        return status_code, body, relay_name
+    
+    raise RelayUnavailable(f"所有中继均不可用: {last_error}")
+
+def relay_fanout(method, path, relay_names, json_body=None, params=None, timeout=5):
+    """并行发往多个中继，返回 {relay_name: (status_code, body) 或异常}"""
+    futures = {
+        name: _relay_fanout_pool.submit(relay_request, method, path, json_body, params, None, timeout, None, name)
+        for name in relay_names
+    }
+    results = {}
+    for name, future in futures.items():
+        try:
+            status_code, body, _ = future.result()
+            results[name] = (status_code, body)
+        except Exception as e:
+            results[name] = e
+    return results
+
+def check_relay_health():
+    """后台定期并行检查所有中继"""
+    while True:
+        try:
+            relay_fanout('GET', '/health', list(relay_registry.relays), timeout=3)
+            replay_wake_queue()
+        except Exception as e:
+            logger.error(f"中继健康检查失败: {e}")
+        time.sleep(RELAY_HEALTH_INTERVAL)
+
+# ===== 降级模式 =====
+WAKE_QUEUE_TTL = config.get('wake_queue_ttl', 600)  # 排队的唤醒请求有效期（秒）
+
+class WakeQueue:
+    """中继不可用时暂存唤醒请求的持久化队列（SQLite），每个主机最多一条"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._replay_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS wake_queue (
+                    host         TEXT PRIMARY KEY,
+                    requested_at REAL NOT NULL,
+                    expires_at   REAL NOT NULL,
+                    requested_by TEXT
+                )
+            ''')
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+    
+    def enqueue(self, host, requested_by=None):
+        """加入队列；同一主机重复请求只延长有效期，返回过期时间"""
+        now = time.time()
+        expires_at = now + WAKE_QUEUE_TTL
+        with self._connection() as conn:
+            conn.execute(
+                '''INSERT INTO wake_queue (host, requested_at, expires_at, requested_by) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(host) DO UPDATE SET expires_at = excluded.expires_at''',
+                (host, now, expires_at, requested_by)
+            )
+        return expires_at
+    
+    def pending(self):
+        return [dict(row) for row in self._connection().execute('SELECT * FROM wake_queue ORDER BY requested_at')]
+    
+    def remove(self, host):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM wake_queue WHERE host = ?', (host,))
+
+wake_queue = WakeQueue(CREDENTIALS_DB_FILE)
+
+def replay_wake_queue():
+    """中继恢复后重放排队的唤醒请求，丢弃已过期的请求"""
+    if not wake_queue._replay_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        for entry in wake_queue.pending():
+            host = entry['host']
+            if entry['expires_at'] < now or host not in relay_registry.hosts:
+                wake_queue.remove(host)
+                logger.info(f"排队的唤醒请求已过期: {host}")
+                continue
+            if not relay_registry.host_available(host):
+                continue
+            
+            result = wake_host(host)
+            if result['success']:
+                wake_queue.remove(host)
+                logger.info(f"已重放排队的唤醒请求: {host} (排队 {int(now - entry['requested_at'])} 秒, trace {result['trace_id']})")
+    except Exception as e:
+        logger.error(f"重放唤醒队列失败: {e}")
+    finally:
+        wake_queue._replay_lock.release()
+
+# 最近一次成功获取的状态，中继不可用时直接返回并标注时效
+_last_known_state = {}
+
+def remember_state(kind, host, body):
+    _last_known_state[(kind, host)] = (body, time.time())
+
+def last_known_state(kind, host):
+    """返回带时效信息的最近状态；从未获取过时返回 None"""
+    entry = _last_known_state.get((kind, host))
+    if entry is None:
+        return None
+    body, updated_at = entry
+    return dict(body, stale=True, degraded=True, updated_at=updated_at, age_seconds=int(time.time() - updated_at))
+
+# 睡眠任务所在的中继，任务状态查询需发往同一中继
+_job_relays = OrderedDict()
+JOB_RELAYS_LIMIT = 200
+
+def requested_host(allow_all=False):
+    """请求中指定的主机（JSON或查询参数 host），默认第一个主机；仅唤醒支持 all"""
+    data = request.get_json(silent=True) or {}
+    host = data.get('host') or request.args.get('host') or DEFAULT_HOST
+    if not (allow_all and host == 'all') and host not in relay_registry.hosts:
+        raise KeyError(host)
+    return host
+
 # WOL功能路由（保持原有功能）
 @app.route('/wake', methods=['POST'])
 @require_biometric_auth
 def wake_windows():
-    """唤醒Windows主机"""
+    """唤醒Windows主机（host 为 all 时并行唤醒所有主机；中继不可用时排队）"""
     try:
-        url = f"http://{UBUNTU_SERVER_HOST}:{UBUNTU_PORT}/wake"
-        payload = {"mac_address": WINDOWS_MAC}
-        response = requests.post(url, json=payload, timeout=10)
+        host = requested_host(allow_all=True)
+    except KeyError as e:
+        return jsonify({"success": False, "message": f"Unknown host: {e}"}), 400
+    
+    if host == 'all':
+        results = _relay_fanout_pool.map(wake_or_enqueue, relay_registry.hosts)
+        results = dict(zip(relay_registry.hosts, results))
+        queued = [name for name, result in results.items() if result.get('queued')]
+        sent = sum(1 for result in results.values() if result['success'] and not result.get('queued'))
+        message = f"Wake sent to {sent}/{len(results)} hosts"
+        if queued:
+            message += f", {len(queued)} queued until relays recover"
+        success = all(result['success'] for result in results.values())
+        return jsonify({
+            "success": success,
+            "message": message,
+            "queued": queued,
+            "hosts": results
+        }), 202 if queued and success else 200
+    
+    result = wake_or_enqueue(host)
+    if result.get('queued'):
+        return jsonify(result), 202
+    if result['success']:
+        logger.info(f"唤醒命令发送成功: {session.get('username')} -> {host} (trace {result['trace_id']})")
+    return jsonify(result), 200 if result['success'] else 500
+
+def wake_or_enqueue(host):
+    """中继可用时立即唤醒，否则写入唤醒队列待中继恢复后重放"""
+    result = None
+    if relay_registry.host_available(host):
+        result = wake_host(host)
+        if not result.get('relay_unavailable'):
+            return result
+    
+    expires_at = wake_queue.enqueue(host, session.get('username') if has_request_context() else None)
+    logger.warning(f"中继不可用，唤醒请求已排队: {host}")
+    return {
+        "success": True,
+        "queued": True,
+        "message": "中继暂不可用，唤醒请求已排队，恢复后自动发送",
+        "expires_at": expires_at,
+        "error": result['message'] if result else None
+    }
+
+def wake_host(host):
+    """经最健康的中继唤醒单个主机"""
+    # 关联ID贯穿云端与中继，用于统计端到端唤醒耗时
+    trace_id = secrets.token_hex(8)
+    route_entry = time.time()
+    try:
+        payload = {"mac_address": relay_registry.host_mac(host), "trace_id": trace_id, "cloud_ts": route_entry}
+        status_code, result, relay_name = relay_request(
+            'POST', '/wake', payload, headers={'X-Trace-Id': trace_id}, timeout=10, host=host
+        )
         
-        if response.status_code == 200:
-            result = response.json()
-            logger.info(f"唤醒命令发送成功: {session.get('username')}")
-            return jsonify(result)
+        if status_code == 200:
+            result.setdefault('trace_id', trace_id)
+            result['relay'] = relay_name
+            return result
         else:
-            logger.error(f"Ubuntu服务器返回错误状态: {response.status_code}")
-            return jsonify({
+            logger.error(f"Ubuntu服务器返回错误状态: {status_code}")
+            return {
                 "success": False,
-                "message": f"Ubuntu server returned status {response.status_code}"
-            }), 500
-            
+                "message": f"Ubuntu server returned status {status_code}",
+                "trace_id": trace_id
+            }
+    
+    except RelayUnavailable as e:
+        logger.error(f"唤醒Windows失败: {e}")
+        return {
+            "success": False,
+            "relay_unavailable": True,
+            "message": f"Error: {str(e)}",
+            "trace_id": trace_id
+        }
     except Exception as e:
         logger.error(f"唤醒Windows失败: {e}")
-        return jsonify({
+        return {
             "success": False,
-            "message": f"Error: {str(e)}"
-        }), 500
+            "message": f"Error: {str(e)}",
+            "trace_id": trace_id
+        }
+
+@app.route('/wake_history', methods=['GET'])
+@require_biometric_auth
+def wake_history():
+    """获取各主机的开机耗时分位数（并行汇总所有中继的统计）"""
+    results = relay_fanout('GET', '/wake_history', list(relay_registry.relays), params=request.args.to_dict())
+    
+    # 参数错误（如 recent 非整数）由中继校验，原样返回400，不算中继故障
+    for result in results.values():
+        if not isinstance(result, Exception) and result[0] == 400:
+            return jsonify(result[1]), 400
+    
+    hosts, recent, errors = {}, [], {}
+    for relay_name, result in results.items():
+        if isinstance(result, Exception) or result[0] != 200:
+            errors[relay_name] = str(result if isinstance(result, Exception) else result[1])
+            continue
+        body = result[1]
+        for host, stats in body.get('hosts', {}).items():
+            # 同一主机被多个中继唤醒时保留样本较多的统计
+            if host not in hosts or stats['samples'] > hosts[host]['samples']:
+                hosts[host] = dict(stats, relay=relay_name)
+        recent.extend(dict(trace, relay=relay_name) for trace in body.get('recent', []))
+    
+    if errors and not hosts and not recent:
+        logger.error(f"获取唤醒历史失败: {errors}")
+        return jsonify({"error": "所有中继均不可用", "relays": errors}), 502
+    
+    recent.sort(key=lambda trace: trace['ts'].get('packet_sent', 0), reverse=True)
+    return jsonify({"hosts": hosts, "recent": recent, "errors": errors})
 
 @app.route('/sleep', methods=['POST'])
 @require_biometric_auth
 def sleep_windows():
-    """使Windows主机进入睡眠状态"""
+    """使Windows主机进入睡眠状态（中继异步执行，返回任务ID供轮询）"""
+    try:
+        host = requested_host()
+    except KeyError as e:
+        return jsonify({"success": False, "message": f"Unknown host: {e}"}), 400
+    
     try:
-        url = f"http://{UBUNTU_SERVER_HOST}:{UBUNTU_PORT}/sleep"
-        response = requests.post(url, timeout=15)
+        status_code, result, relay_name = relay_request('POST', '/sleep', host=host)
         
-        if response.status_code == 200:
-            result = response.json()
-            logger.info(f"睡眠命令发送成功: {session.get('username')}")
-            return jsonify(result)
+        if status_code in (200, 202):
+            _job_relays[result['job_id']] = relay_name
+            while len(_job_relays) > JOB_RELAYS_LIMIT:
+                _job_relays.popitem(last=False)
+            logger.info(f"睡眠任务已提交: {session.get('username')} -> {host} via {relay_name} (job {result.get('job_id')})")
+            return jsonify(dict(result, relay=relay_name)), status_code
         else:
-            logger.error(f"Ubuntu服务器返回错误状态: {response.status_code}")
+            logger.error(f"Ubuntu服务器返回错误状态: {status_code}")
             return jsonify({
                 "success": False,
-                "message": f"Ubuntu server returned status {response.status_code}"
+                "message": f"Ubuntu server returned status {status_code}"
             }), 500
             
     except Exception as e:
@@ -703,46 +1866,131 @@ def sleep_windows():
             "message": f"Error: {str(e)}"
         }), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_biometric_auth
+def job_status(job_id):
+    """查询中继上睡眠任务的进度"""
+    relay_name = _job_relays.get(job_id)
+    if relay_name is None:
+        return jsonify({"success": False, "message": "Job not found"}), 404
+    try:
+        status_code, result, _ = relay_request('GET', f'/jobs/{job_id}', relay=relay_name)
+        return jsonify(result), status_code
+    except Exception as e:
+        logger.error(f"查询任务状态失败: {e}")
+        return jsonify({"success": False, "message": f"Error: {str(e)}"}), 502
+
 @app.route('/status', methods=['GET'])
 @require_biometric_auth
 def check_status():
-    """检查Ubuntu服务器状态"""
+    """检查Ubuntu服务器状态（并行检查可用的中继，已知故障的中继直接返回上次检查结果）"""
+    available = [name for name in relay_registry.relays if relay_registry.is_available(name)]
+    results = relay_fanout('GET', '/health', available) if available else {}
+    
+    health = relay_registry.snapshot()
+    relays = {}
+    for name in relay_registry.relays:
+        result = results.get(name)
+        online = result is not None and not isinstance(result, Exception) and result[0] == 200
+        relays[name] = {"status": "online" if online else "offline", "last_ok": health[name]['last_ok']}
+    
+    online = any(relay['status'] == 'online' for relay in relays.values())
+    return jsonify({
+        "ubuntu_server": "online" if online else "offline",
+        "degraded": not online,
+        "queued_wakes": [entry['host'] for entry in wake_queue.pending()],
+        "relays": relays
+    })
+
+@app.route('/telemetry', methods=['GET'])
+@require_biometric_auth
+def host_telemetry():
+    """获取Windows主机遥测数据（读取中继缓存；中继不可用时返回最近的已知数据）"""
     try:
-        url = f"http://{UBUNTU_SERVER_HOST}:{UBUNTU_PORT}/health"
-        response = requests.get(url, timeout=5)
-        
-        if response.status_code == 200:
-            return jsonify({"ubuntu_server": "online"})
-        else:
-            return jsonify({"ubuntu_server": "error"})
-    except:
-        return jsonify({"ubuntu_server": "offline"})
+        host = requested_host()
+    except KeyError as e:
+        return jsonify({"telemetry": None, "error": f"Unknown host: {e}"}), 400
+    
+    if not relay_registry.host_available(host):
+        return jsonify(last_known_telemetry(host))
+    try:
+        force = request.args.get('refresh') == '1'
+        # 强制刷新时中继需要现场SSH采集，超时放宽；平时只读缓存
+        status_code, result, relay_name = relay_request(
+            'GET', '/telemetry', params={'refresh': '1'} if force else None, timeout=100 if force else 5, host=host
+        )
+        result = dict(result or {}, relay=relay_name)
+        if status_code == 200 and result.get('telemetry'):
+            # 记录采集时刻，降级时据此换算数据年龄
+            collected_at = time.time() - (result.get('age_seconds') or 0)
+            remember_state('telemetry', host, dict(result, collected_at=collected_at))
+        return jsonify(result), status_code
+    except Exception as e:
+        logger.error(f"获取主机遥测失败: {e}")
+        return jsonify(last_known_telemetry(host))
+
+def last_known_telemetry(host):
+    result = last_known_state('telemetry', host)
+    if result is None:
+        return {"telemetry": None, "degraded": True}
+    result['age_seconds'] = int(time.time() - result.pop('collected_at'))
+    return result
+
+@app.route('/relays', methods=['GET'])
+@require_biometric_auth
+def relay_health():
+    """中继健康分数和主机路由"""
+    return jsonify({
+        "relays": relay_registry.snapshot(),
+        "hosts": {name: {"relays": relay_registry.relays_for(name)} for name in relay_registry.hosts}
+    })
 
 @app.route('/win_status', methods=['GET'])
 @require_biometric_auth
 def win_status():
     """获取Windows主机状态"""
     try:
-        url = f"http://{UBUNTU_SERVER_HOST}:{UBUNTU_PORT}/win_status"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            return jsonify(response.json())
+        host = requested_host()
+    except KeyError as e:
+        return jsonify({"online": False, "error": f"Unknown host: {e}"}), 400
+    
+    # 优先使用中继主动推送的最新状态
+    for relay_name in relay_registry.relays_for(host):
+        channel = relay_registry.channel_for(relay_name)
+        state = channel.fresh_state() if channel else None
+        if state is not None:
+            result = {"win_status": state['win_status'], "updated_at": state['ts']}
+            remember_state('win_status', host, result)
+            return jsonify(result)
+    
+    # 降级模式：所有中继都不可用时不再等待超时，直接返回最近的已知状态
+    if not relay_registry.host_available(host):
+        return jsonify(last_known_state('win_status', host) or {"online": False, "degraded": True})
+    try:
+        status_code, result, _ = relay_request('GET', '/win_status', host=host)
+        if status_code == 200:
+            remember_state('win_status', host, result)
+            return jsonify(result)
         else:
             return jsonify({"online": False})
     except:
-        return jsonify({"online": False})
+        return jsonify(last_known_state('win_status', host) or {"online": False, "degraded": True})
+
+# 所有路由和队列就绪后再启动后台健康检查
+threading.Thread(target=check_relay_health, name='relay-health', daemon=True).start()
 
 if __name__ == '__main__':
     print("=== WOL远程控制系统 - 生产模式 ===")
     print("Flask应用运行在: http://127.0.0.1:5000")
     print("公网访问地址: https://wol.gofoyi.shop")
     print("请确保Nginx反向代理已正确配置")
-    print(f"Ubuntu服务器: {UBUNTU_SERVER_HOST}:{UBUNTU_PORT}")
-    print(f"Windows主机MAC: {WINDOWS_MAC}")
-    print(f"用户凭据存储文件: {USER_CREDENTIALS_FILE}")
+    for relay_name, relay in relay_registry.relays.items():
+        print(f"中继 {relay_name}: {relay.get('host') or '仅控制通道'}:{relay.get('port', 5000)}")
+    print(f"中继控制通道: {'已启用 /relay/channel' if RELAY_CHANNEL_ENABLED and Sock else '未启用'}")
+    for host_name, host in relay_registry.hosts.items():
+        print(f"主机 {host_name}: {host['mac']} (中继 {', '.join(host['relays'])})")
+    print(f"用户凭据数据库: {CREDENTIALS_DB_FILE} ({credential_store.count_users()} 个用户)")
     print("=====================================")
-      # 确保存储目录存在
-    os.makedirs(os.path.dirname(os.path.abspath(USER_CREDENTIALS_FILE)), exist_ok=True)
     
     # 只在本地运行HTTP，让Nginx处理HTTPS
     app.run(
@@ -5,7 +5,20 @@ import sys
 import json
 import paramiko
 import os
-from flask import Flask, request, jsonify
+import time
+import random
+import base64
+import math
+import hmac
+import hashlib
+import re
+import cProfile
+import threading
+import select
+import ipaddress
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, g
 
 app = Flask(__name__)
 
@@ -34,57 +47,331 @@ WINDOWS_SSH_USER = config['windows_ssh_user']
 WINDOWS_SSH_PASSWORD = config['windows_ssh_password']
 WINDOWS_SSH_PORT = config['windows_ssh_port']
 
-def send_magic_packet(mac_address, broadcast_ip='255.255.255.255', port=9):
-    """发送Magic包唤醒设备"""
+# ===== 请求性能分析（可选，默认关闭） =====
+# WOL_PROFILE_RATE: 随机采样比例(0~1)；WOL_PROFILE_TOKEN: 管理员令牌，请求头 X-WOL-Profile 携带时强制分析
+PROFILE_RATE = float(os.getenv('WOL_PROFILE_RATE', '0'))
+PROFILE_TOKEN = os.getenv('WOL_PROFILE_TOKEN')
+PROFILE_DIR = os.getenv('WOL_PROFILE_DIR', os.path.join(os.path.dirname(__file__), 'profiles'))
+PROFILE_MAX_FILES = int(os.getenv('WOL_PROFILE_MAX_FILES', '50'))
+# Python 3.12起cProfile基于进程级的 sys.monitoring，会同时记录其他线程（并发请求、后台线程）的调用；
+# 与其他请求重叠的分析文件名带 _mixed 标记
+PROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)
+_profile_lock = threading.Lock()
+_requests_in_flight = 0
+_requests_started = 0
+
+def track_request_start():
+    global _requests_in_flight, _requests_started
+    g.profile_tracked = True
+    with _profile_lock:
+        _requests_in_flight += 1
+        _requests_started += 1
+
+def track_request_end(exc=None):
+    global _requests_in_flight
+    if g.pop('profile_tracked', False):
+        with _profile_lock:
+            _requests_in_flight -= 1
+
+def start_request_profile():
+    """按采样比例或管理员请求头开启本次请求的cProfile"""
+    token = request.headers.get('X-WOL-Profile')
+    forced = bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+    if not forced and random.random() >= PROFILE_RATE:
+        return
+    
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 其他线程的分析器仍在运行
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+    with _profile_lock:
+        g.profile_overlap = (_requests_started, _requests_in_flight > 1)
+
+def finish_request_profile(response):
+    """保存pstats文件，文件名包含时间、路由、耗时和状态码"""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    
+    latency_ms = int((time.perf_counter() - g.pop('profile_started')) * 1000)
+    started_count, overlapped = g.pop('profile_overlap')
+    with _profile_lock:
+        overlapped = overlapped or _requests_started != started_count or _requests_in_flight > 1
+    mixed = '_mixed' if PROFILE_PROCESS_WIDE and overlapped else ''
+    route = request.url_rule.rule if request.url_rule else request.path
+    safe_route = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{request.method}_{safe_route}_{latency_ms}ms_{response.status_code}{mixed}_{os.urandom(2).hex()}.pstats"
+    
+    try:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        # 只保留最近的 PROFILE_MAX_FILES 个文件
+        profiles = sorted(
+            (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.pstats')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in profiles[:-PROFILE_MAX_FILES]:
+            os.remove(entry.path)
+        response.headers['X-WOL-Profile-File'] = filename
+    except OSError as e:
+        print(f"Failed to save profile: {e}")
+    return response
+
+# 未启用时不注册任何钩子，对请求零开销
+if PROFILE_RATE > 0 or PROFILE_TOKEN:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    app.before_request(track_request_start)
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(track_request_end)
+
+# 唤醒包投递策略（可选配置，缺省时为连发3轮、端口7和9）
+WOL_BROADCAST_IP = config.get('wol_broadcast_ip', '255.255.255.255')
+WOL_PORTS = config.get('wol_ports', [7, 9])
+WOL_BURST_COUNT = max(1, int(config.get('wol_burst_count', 3)))
+WOL_BURST_JITTER_MS = config.get('wol_burst_jitter_ms', [20, 80])
+WOL_IPV6_INTERFACE = config.get('wol_ipv6_interface')  # 例如 "eth0"，为空则不发送IPv6组播
+WOL_SECUREON_PASSWORD = config.get('wol_secureon_password')  # 例如 "00:11:22:33:44:55"
+
+def build_magic_packet(mac_address, secureon_password=None):
+    """构造Magic包，可附加6字节SecureOn密码"""
     # 移除MAC地址中的分隔符
     mac_address = mac_address.replace(':', '').replace('-', '')
     
     # 验证MAC地址格式
     if len(mac_address) != 12:
-        return False, "Invalid MAC address format"
+        raise ValueError("Invalid MAC address format")
+    
+    # Magic包格式: 6个0xFF + 16次重复的MAC地址 [+ 6字节SecureOn密码]
+    magic_packet = b'\xff' * 6 + bytes.fromhex(mac_address) * 16
+    
+    if secureon_password:
+        password = secureon_password.replace(':', '').replace('-', '')
+        if len(password) != 12:
+            raise ValueError("Invalid SecureOn password format")
+        magic_packet += bytes.fromhex(password)
+    
+    return magic_packet
+
+def _wol_targets():
+    """列出所有投递目标: (协议族, 地址元组, 描述地址)"""
+    targets = [(socket.AF_INET, (WOL_BROADCAST_IP, port), WOL_BROADCAST_IP) for port in WOL_PORTS]
     
+    if WOL_IPV6_INTERFACE:
+        # ff02::1 为链路本地全节点组播地址，必须指定出口网卡
+        scope_id = socket.if_nametoindex(WOL_IPV6_INTERFACE)
+        targets += [
+            (socket.AF_INET6, ('ff02::1', port, 0, scope_id), f"ff02::1%{WOL_IPV6_INTERFACE}")
+            for port in WOL_PORTS
+        ]
+    return targets
+
+def send_magic_packet_burst(mac_address, secureon_password=None):
+    """按配置连发Magic包（多端口、IPv4广播+IPv6组播、随机抖动）
+    
+    返回 (success, message, variants)，variants 记录每一个实际发出的变体，
+    便于统计哪种组合首发唤醒率最高。
+    """
     try:
-        # 创建Magic包
-        # Magic包格式: 6个0xFF + 16次重复的MAC地址
-        magic_packet = b'\xff' * 6
-        mac_bytes = bytes.fromhex(mac_address)
-        magic_packet += mac_bytes * 16
-        
-        # 发送UDP包
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.sendto(magic_packet, (broadcast_ip, port))
-        sock.close()
+        magic_packet = build_magic_packet(mac_address, secureon_password)
+        targets = _wol_targets()
+    except (ValueError, OSError) as e:
+        return False, str(e), []
+    
+    sockets = {}
+    variants = []
+    try:
+        for family, address, _ in targets:
+            if family in sockets:
+                continue
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            else:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, address[3])
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, 1)
+            sockets[family] = sock
         
-        return True, "Magic packet sent successfully"
-    except Exception as e:
-        return False, f"Error sending magic packet: {str(e)}"
+        for attempt in range(1, WOL_BURST_COUNT + 1):
+            for family, address, label in targets:
+                variant = {
+                    "attempt": attempt,
+                    "family": "ipv6" if family == socket.AF_INET6 else "ipv4",
+                    "address": label,
+                    "port": address[1],
+                    "secureon": bool(secureon_password),
+                    "sent_at": time.time(),
+                }
+                try:
+                    sockets[family].sendto(magic_packet, address)
+                    variant["sent"] = True
+                except OSError as e:
+                    variant["sent"] = False
+                    variant["error"] = str(e)
+                variants.append(variant)
+            
+            # 轮次之间加入随机抖动，避免与交换机/网卡的瞬时丢包窗口重合
+            if attempt < WOL_BURST_COUNT:
+                time.sleep(random.uniform(*WOL_BURST_JITTER_MS) / 1000.0)
+    finally:
+        for sock in sockets.values():
+            sock.close()
+    
+    sent = sum(1 for v in variants if v["sent"])
+    if sent == 0:
+        return False, f"Error sending magic packet: {variants[-1].get('error') if variants else 'no targets'}", variants
+    return True, f"Magic packet sent successfully ({sent}/{len(variants)} variants)", variants
+
+def summarize_variants(variants):
+    """汇总一次连发的投递组合，随唤醒追踪记录一起保存"""
+    sent = [v for v in variants if v["sent"]]
+    return {
+        "burst_count": max((v["attempt"] for v in variants), default=0),
+        "ports": sorted({v["port"] for v in sent}),
+        "families": sorted({v["family"] for v in sent}),
+        "secureon": any(v["secureon"] for v in variants),
+        "sent": len(sent),
+        "total": len(variants),
+    }
+
+def check_port_open(host, port, timeout=1.0):
+    """检查目标TCP端口是否可连接"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+# ===== 熔断 =====
+CIRCUIT_FAILURE_THRESHOLD = config.get('circuit_failure_threshold', 3)  # 连续失败次数达到后熔断
+CIRCUIT_RESET_TIMEOUT = config.get('circuit_reset_timeout', 30)  # 熔断后多久放行一次试探（秒）
+
+class CircuitOpenError(Exception):
+    """熔断打开期间直接拒绝请求"""
+
+class CircuitBreaker:
+    """单个主机访问路径的熔断器
+    
+    closed: 正常放行；连续失败达到阈值后转为 open，直接拒绝；
+    冷却时间过后转为 half_open，只放行一次试探，成功则恢复 closed，失败则重新 open。
+    """
+    
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+    
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.trial_in_flight = False
+            if self.state == 'half_open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+    
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                print(f"Circuit {self.name} closed")
+            self.state = 'closed'
+            self.failures = 0
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"Circuit {self.name} opened after {self.failures} failures")
+                self.state = 'open'
+                self.opened_at = time.time()
+    
+    def reset(self):
+        """已知主机状态将发生变化（如刚发送唤醒包）时立即恢复放行"""
+        self.record_success()
+    
+    def retry_after(self):
+        with self.lock:
+            if self.state != 'open':
+                return 0
+            return max(0, math.ceil(self.opened_at + self.reset_timeout - time.time()))
+    
+    def snapshot(self):
+        return {"state": self.state, "failures": self.failures, "retry_after": self.retry_after()}
+
+probe_breaker = CircuitBreaker(f"{WINDOWS_HOST_IP}/probe")
+ssh_breaker = CircuitBreaker(f"{WINDOWS_HOST_IP}/ssh")
 
-def check_windows_status():
-    """检查Windows主机是否在线"""
+def check_windows_status(use_breaker=True):
+    """检查Windows主机是否在线（探测熔断打开期间直接视为离线）"""
+    if use_breaker and not probe_breaker.allow():
+        return False
     try:
         import subprocess
         cmd = ['ping', '-c', '1', '-W', '1', WINDOWS_HOST_IP]
         result = subprocess.run(cmd, capture_output=True, text=True)
-        return result.returncode == 0
+        online = result.returncode == 0
     except:
-        return False
+        online = False
+    
+    # 绕过熔断的探测（如唤醒耗时追踪）不影响熔断器状态
+    if use_breaker:
+        if online:
+            probe_breaker.record_success()
+        else:
+            probe_breaker.record_failure()
+    return online
 
-def sleep_windows_via_ssh():
-    """通过SSH使Windows主机进入睡眠状态(使用优化的PowerShell命令)"""
+def open_ssh_client(timeout=10):
+    """创建并连接到Windows主机的SSH客户端（受SSH熔断器保护）"""
+    if not ssh_breaker.allow():
+        raise CircuitOpenError(f"SSH circuit open for {WINDOWS_HOST_IP}, retry in {ssh_breaker.retry_after()}s")
+    
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        # 创建SSH客户端
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # 连接到Windows主机
         ssh.connect(
             hostname=WINDOWS_HOST_IP,
             port=WINDOWS_SSH_PORT,
             username=WINDOWS_SSH_USER,
             password=WINDOWS_SSH_PASSWORD,
-            timeout=10
+            timeout=timeout
         )
+    except paramiko.AuthenticationException:
+        # 主机可达，只是认证失败，不计入熔断
+        ssh_breaker.record_success()
+        raise
+    except Exception:
+        ssh_breaker.record_failure()
+        raise
+    ssh_breaker.record_success()
+    return ssh
+
+def sleep_windows_via_ssh(progress=None):
+    """通过SSH使Windows主机进入睡眠状态(使用优化的PowerShell命令)
+    
+    progress 为可选回调 progress(step, message)，用于上报执行进度。
+    返回 (success, message, method)，method 为最终生效的命令名称。
+    """
+    report = progress or (lambda step, message: None)
+    try:
+        # 连接到Windows主机
+        report('connecting', f"Connecting to {WINDOWS_HOST_IP}:{WINDOWS_SSH_PORT}")
+        ssh = open_ssh_client()
         
         # 使用您提供的优化命令：直接进入睡眠模式，无需禁用休眠
         # SetSuspendState参数说明:
@@ -103,35 +390,368 @@ def sleep_windows_via_ssh():
         
         try:
             # 首先尝试主要的睡眠命令
+            report('primary', "Sending primary sleep command")
             stdin, stdout, stderr = ssh.exec_command(powershell_sleep_cmd, timeout=5)
             # 不等待命令完成，因为主机会立即进入睡眠
             ssh.close()
-            return True, "Sleep command sent successfully."
+            return True, "Sleep command sent successfully.", 'primary'
             
         except Exception as e:
             # 如果主命令失败，尝试备用命令
             for i, backup_cmd in enumerate(backup_commands):
                 try:
+                    report(f'backup_{i+1}', f"Primary command failed, trying backup method {i+1}")
                     stdin, stdout, stderr = ssh.exec_command(backup_cmd, timeout=3)
                     ssh.close()
-                    return True, f"Sleep command sent successfully (backup method {i+1})"
+                    return True, f"Sleep command sent successfully (backup method {i+1})", f'backup_{i+1}'
                 except:
                     continue
             
             # 所有方法都失败
             ssh.close()
-            return False, f"All sleep methods failed. Last error: {str(e)}"
+            ssh_breaker.record_failure()
+            return False, f"All sleep methods failed. Last error: {str(e)}", None
         
+    except CircuitOpenError as e:
+        return False, str(e), None
     except paramiko.AuthenticationException:
-        return False, "SSH authentication failed"
+        return False, "SSH authentication failed", None
     except paramiko.SSHException as e:
-        return False, f"SSH connection error: {str(e)}"
+        return False, f"SSH connection error: {str(e)}", None
     except Exception as e:
-        return False, f"Error sending sleep command: {str(e)}"
+        return False, f"Error sending sleep command: {str(e)}", None
+
+# ===== 睡眠任务 =====
+SLEEP_JOB_WORKERS = config.get('sleep_job_workers', 2)
+SLEEP_JOB_RETENTION = config.get('sleep_job_retention', 100)  # 内存中最多保留的任务数
+
+sleep_executor = ThreadPoolExecutor(max_workers=SLEEP_JOB_WORKERS, thread_name_prefix='sleep-job')
+SLEEP_JOBS = OrderedDict()
+SLEEP_JOBS_LOCK = threading.Lock()
+
+def _update_job(job_id, **fields):
+    with SLEEP_JOBS_LOCK:
+        job = SLEEP_JOBS.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+def _job_progress(job_id, step, message):
+    with SLEEP_JOBS_LOCK:
+        job = SLEEP_JOBS.get(job_id)
+        if job is not None:
+            job['step'] = step
+            job['progress'].append({"step": step, "message": message, "at": time.time()})
+
+def run_sleep_job(job_id):
+    """在工作线程中执行 Ping 检查 + SSH 睡眠命令"""
+    _update_job(job_id, status='running', started_at=time.time())
+    try:
+        _job_progress(job_id, 'probing', f"Pinging {WINDOWS_HOST_IP}")
+        if not check_windows_status():
+            message = "Windows主机离线或无法访问"
+            if probe_breaker.state == 'open':
+                message += f"（熔断中，{probe_breaker.retry_after()}秒后重试探测）"
+            success, method = False, None
+        else:
+            success, message, method = sleep_windows_via_ssh(
+                lambda step, msg: _job_progress(job_id, step, msg)
+            )
+    except Exception as e:
+        success, message, method = False, f"Server error: {str(e)}", None
+    
+    _update_job(
+        job_id,
+        status='succeeded' if success else 'failed',
+        success=success,
+        message=message,
+        method=method,
+        finished_at=time.time()
+    )
+
+def submit_sleep_job():
+    """提交睡眠任务；已有未完成的任务时直接复用，避免重复SSH"""
+    with SLEEP_JOBS_LOCK:
+        for job in SLEEP_JOBS.values():
+            if job['status'] in ('queued', 'running'):
+                return job['job_id'], False
+        
+        job_id = os.urandom(8).hex()
+        SLEEP_JOBS[job_id] = {
+            "job_id": job_id,
+            "type": "sleep",
+            "status": "queued",
+            "step": None,
+            "progress": [],
+            "success": None,
+            "message": None,
+            "method": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None
+        }
+        # 只淘汰已完成的旧任务
+        while len(SLEEP_JOBS) > SLEEP_JOB_RETENTION:
+            oldest_id, oldest = next(iter(SLEEP_JOBS.items()))
+            if oldest['status'] in ('queued', 'running'):
+                break
+            del SLEEP_JOBS[oldest_id]
+    
+    sleep_executor.submit(run_sleep_job, job_id)
+    return job_id, True
+
+def get_sleep_job(job_id):
+    with SLEEP_JOBS_LOCK:
+        job = SLEEP_JOBS.get(job_id)
+        return None if job is None else dict(job, progress=list(job['progress']))
+
+# ===== 唤醒耗时追踪 =====
+WAKE_TRACE_FILE = os.path.join(os.path.dirname(__file__), config.get('wake_trace_file', 'wake_traces.jsonl'))
+WAKE_TRACE_RING_SIZE = config.get('wake_trace_ring_size', 500)
+WAKE_PROBE_TIMEOUT = config.get('wake_probe_timeout', 300)  # 最多追踪5分钟
+WAKE_PROBE_INTERVAL = 1.0
+# 发包后这么短时间内就探测成功，说明主机本来就在线，不计入开机耗时统计
+WAKE_ALREADY_ONLINE_THRESHOLD = 1.0
+
+class WakeTraceStore:
+    """唤醒耗时记录：内存环形缓冲 + 追加写入的JSONL文件
+    
+    每条记录的 ts 字段按事件名保存时间戳: cloud_route_entry, relay_receipt,
+    packet_sent, first_probe_ok, ssh_reachable；delivery 字段保存本次连发的
+    投递组合（端口、协议族、SecureOn、轮数），用于关联首发唤醒成功率
+    """
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.traces = deque(maxlen=size)
+        self.active = {}
+        self._file_lines = 0
+        self._load()
+    
+    def _load(self):
+        """启动时从磁盘恢复最近的记录"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._file_lines += 1
+                    try:
+                        self.traces.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError as e:
+            print(f"Failed to load wake traces: {e}")
+    
+    def start(self, trace_id, host, ts=None, delivery=None):
+        trace = {"id": trace_id, "host": host, "status": "probing", "ts": dict(ts or {}), "delivery": delivery}
+        with self.lock:
+            self.active[trace_id] = trace
+        return trace
+    
+    def mark(self, trace_id, event, when=None):
+        with self.lock:
+            trace = self.active.get(trace_id)
+            if trace is not None:
+                trace["ts"].setdefault(event, when or time.time())
+    
+    def finish(self, trace_id, status):
+        with self.lock:
+            trace = self.active.pop(trace_id, None)
+            if trace is None:
+                return
+            trace["status"] = status
+            self.traces.append(trace)
+            self._persist(trace)
+    
+    def _persist(self, trace):
+        """追加写入一行；文件超过两倍缓冲大小时压缩为最近的记录"""
+        try:
+            if self._file_lines >= self.size * 2:
+                tmp_file = f"{self.path}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    for item in self.traces:
+                        f.write(json.dumps(item, separators=(',', ':')) + '\n')
+                os.replace(tmp_file, self.path)
+                self._file_lines = len(self.traces)
+            else:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(trace, separators=(',', ':')) + '\n')
+                self._file_lines += 1
+        except OSError as e:
+            print(f"Failed to persist wake trace: {e}")
+    
+    def get(self, trace_id):
+        with self.lock:
+            if trace_id in self.active:
+                return dict(self.active[trace_id])
+            for trace in self.traces:
+                if trace["id"] == trace_id:
+                    return dict(trace)
+        return None
+    
+    def recent(self, limit=20):
+        with self.lock:
+            return list(self.traces)[-limit:][::-1]
+    
+    def history(self):
+        """按主机统计开机耗时分位数"""
+        with self.lock:
+            traces = list(self.traces)
+        
+        durations = {}
+        for trace in traces:
+            ts = trace["ts"]
+            if trace["status"] != "completed" or 'packet_sent' not in ts:
+                continue
+            if ts.get('first_probe_ok', 0) - ts['packet_sent'] < WAKE_ALREADY_ONLINE_THRESHOLD:
+                continue
+            host = durations.setdefault(trace["host"], {"boot_seconds": [], "ssh_ready_seconds": [], "end_to_end_seconds": []})
+            host["boot_seconds"].append(ts['first_probe_ok'] - ts['packet_sent'])
+            host["ssh_ready_seconds"].append(ts['ssh_reachable'] - ts['packet_sent'])
+            if 'cloud_route_entry' in ts:
+                # 云端与中继的时钟偏差会直接计入该项
+                host["end_to_end_seconds"].append(ts['ssh_reachable'] - ts['cloud_route_entry'])
+        
+        return {
+            host: dict(
+                {"samples": len(series["boot_seconds"])},
+                **{name: _percentiles(values) for name, values in series.items()}
+            )
+            for host, series in durations.items()
+        }
+
+def _percentiles(values):
+    """最近秩法计算 p50/p90/p99"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = {}
+    for p in (50, 90, 99):
+        rank = min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))
+        result[f"p{p}"] = round(ordered[rank], 2)
+    result["max"] = round(ordered[-1], 2)
+    return result
+
+wake_traces = WakeTraceStore(WAKE_TRACE_FILE, WAKE_TRACE_RING_SIZE)
+
+def start_wake_trace(trace_id, mac_address, variants, timestamps):
+    """唤醒包发出后复位熔断器，并在后台追踪主机上线耗时"""
+    # 主机即将上线，熔断器立即恢复放行
+    probe_breaker.reset()
+    ssh_breaker.reset()
+    
+    timestamps = dict(timestamps, packet_sent=next(v['sent_at'] for v in variants if v['sent']))
+    wake_traces.start(trace_id, mac_address.upper().replace('-', ':'), timestamps, summarize_variants(variants))
+    threading.Thread(target=probe_wake_progress, args=(trace_id,), daemon=True).start()
+
+def probe_wake_progress(trace_id):
+    """后台探测主机从发包到可Ping、再到SSH端口可连接的时间"""
+    deadline = time.time() + WAKE_PROBE_TIMEOUT
+    pinged = False
+    while time.time() < deadline:
+        if not pinged and check_windows_status(use_breaker=False):
+            wake_traces.mark(trace_id, 'first_probe_ok')
+            pinged = True
+        if pinged and check_port_open(WINDOWS_HOST_IP, WINDOWS_SSH_PORT):
+            wake_traces.mark(trace_id, 'ssh_reachable')
+            wake_traces.finish(trace_id, 'completed')
+            return
+        time.sleep(WAKE_PROBE_INTERVAL)
+    wake_traces.finish(trace_id, 'timeout')
+
+# ===== 主机遥测 =====
+TELEMETRY_TTL = config.get('telemetry_ttl', 300)  # 缓存有效期（秒），查询待装更新较慢
+TELEMETRY_EXEC_TIMEOUT = 90
+
+# 一次PowerShell调用采集全部指标，输出单行JSON
+TELEMETRY_SCRIPT = r'''
+$ErrorActionPreference = 'SilentlyContinue'
+$os = Get-CimInstance Win32_OperatingSystem
+$cpu = (Get-CimInstance Win32_Processor | Measure-Object -Property LoadPercentage -Average).Average
+$users = @(quser 2>$null | Select-Object -Skip 1 | ForEach-Object { (($_.Trim() -replace '^>', '') -split '\s+')[0] })
+try {
+    $updates = (New-Object -ComObject Microsoft.Update.Session).CreateUpdateSearcher().Search("IsInstalled=0 and IsHidden=0 and Type='Software'").Updates.Count
+} catch { $updates = $null }
+[pscustomobject]@{
+    uptime_seconds = [int]((Get-Date) - $os.LastBootUpTime).TotalSeconds
+    cpu_load_percent = $cpu
+    memory_total_mb = [int]($os.TotalVisibleMemorySize / 1024)
+    memory_free_mb = [int]($os.FreePhysicalMemory / 1024)
+    logged_in_users = $users
+    pending_updates = $updates
+} | ConvertTo-Json -Compress
+'''
+
+class TelemetryCache:
+    """遥测结果缓存（TTL），同一时间只允许一个SSH采集"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.data = None
+        self.collected_at = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+    
+    def snapshot(self):
+        with self.lock:
+            age = None if self.collected_at is None else time.time() - self.collected_at
+            return {
+                "telemetry": self.data,
+                "collected_at": self.collected_at,
+                "age_seconds": None if age is None else round(age, 1),
+                "stale": age is None or age > self.ttl,
+                "error": self.error
+            }
+    
+    def is_fresh(self):
+        with self.lock:
+            return self.collected_at is not None and time.time() - self.collected_at <= self.ttl
+    
+    def refresh(self):
+        """采集一次；已有采集在进行时直接返回，由调用方读取现有缓存"""
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            data = collect_telemetry()
+            with self.lock:
+                self.data, self.collected_at, self.error = data, time.time(), None
+        except Exception as e:
+            with self.lock:
+                self.error = str(e)
+        finally:
+            self.refresh_lock.release()
+
+def collect_telemetry():
+    """通过一次SSH会话执行批量PowerShell脚本"""
+    encoded = base64.b64encode(TELEMETRY_SCRIPT.encode('utf-16-le')).decode('ascii')
+    ssh = open_ssh_client()
+    try:
+        stdin, stdout, stderr = ssh.exec_command(
+            f'powershell.exe -NoProfile -NonInteractive -EncodedCommand {encoded}',
+            timeout=TELEMETRY_EXEC_TIMEOUT
+        )
+        output = stdout.read().decode('utf-8', errors='replace').strip()
+    finally:
+        ssh.close()
+    
+    if not output:
+        raise RuntimeError("Telemetry command returned no output")
+    return json.loads(output.splitlines()[-1])
+
+telemetry_cache = TelemetryCache(TELEMETRY_TTL)
+
+def refresh_telemetry_if_online():
+    """主机离线时不尝试SSH，保留上次的数据"""
+    if check_windows_status():
+        telemetry_cache.refresh()
 
 @app.route('/wake', methods=['POST'])
 def wake_device():
     """接收来自云服务器的唤醒请求"""
+    relay_receipt = time.time()
     try:
         data = request.get_json()
         mac_address = data.get('mac_address')
@@ -139,11 +759,31 @@ def wake_device():
         if not mac_address:
             return jsonify({"success": False, "message": "MAC address required"}), 400
         
-        success, message = send_magic_packet(mac_address)
+        # 在发包之前校验，避免唤醒包已发出却返回错误
+        timestamps = {'relay_receipt': relay_receipt}
+        if data.get('cloud_ts'):
+            try:
+                timestamps['cloud_route_entry'] = float(data['cloud_ts'])
+            except (TypeError, ValueError):
+                timestamps['cloud_route_entry'] = math.nan
+            if not math.isfinite(timestamps['cloud_route_entry']):
+                return jsonify({"success": False, "message": "cloud_ts must be a number"}), 400
+        
+        success, message, variants = send_magic_packet_burst(
+            mac_address, data.get('secureon_password', WOL_SECUREON_PASSWORD)
+        )
+        print(f"Wake {mac_address}: {message}")
+        
+        # 关联ID由云服务器生成，直接调用中继时自行生成
+        trace_id = data.get('trace_id') or request.headers.get('X-Trace-Id') or os.urandom(8).hex()
+        if success:
+            start_wake_trace(trace_id, mac_address, variants, timestamps)
         
         return jsonify({
             "success": success,
-            "message": message
+            "message": message,
+            "variants": variants,
+            "trace_id": trace_id
         })
     except Exception as e:
         return jsonify({
@@ -153,32 +793,37 @@ def wake_device():
 
 @app.route('/sleep', methods=['POST'])
 def sleep_device():
-    """使Windows主机进入睡眠状态"""
+    """使Windows主机进入睡眠状态（异步任务，立即返回任务ID）"""
     try:
-        # 首先检查Windows主机是否在线
-        if not check_windows_status():
-            return jsonify({
-                "success": False,
-                "message": "Windows主机离线或无法访问"
-            })
-        
-        success, message = sleep_windows_via_ssh()
+        job_id, created = submit_sleep_job()
         
         return jsonify({
-            "success": success,
-            "message": message
-        })
+            "success": True,
+            "job_id": job_id,
+            "status": "queued" if created else get_sleep_job(job_id)['status'],
+            "message": "Sleep job accepted" if created else "Sleep job already in progress"
+        }), 202
     except Exception as e:
         return jsonify({
             "success": False,
             "message": f"Server error: {str(e)}"
         }), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询睡眠任务的进度和结果"""
+    job = get_sleep_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Job not found"}), 404
+    return jsonify(job)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
-    return jsonify({"status": "healthy"})
+    return jsonify({
+        "status": "healthy",
+        "circuits": {"probe": probe_breaker.snapshot(), "ssh": ssh_breaker.snapshot()}
+    })
 
 @app.route('/win_status', methods=['GET'])
 def win_status():
@@ -187,7 +832,8 @@ def win_status():
         windows_online = check_windows_status()
         
         return jsonify({
-            "win_status": "online" if windows_online else "offline"
+            "win_status": "online" if windows_online else "offline",
+            "circuit": probe_breaker.state
         })
     except Exception as e:
         return jsonify({
@@ -195,6 +841,375 @@ def win_status():
             "error": str(e)
         })
 
+@app.route('/telemetry', methods=['GET'])
+def telemetry():
+    """获取Windows主机遥测数据
+    
+    只读缓存；缓存过期时在后台刷新（页面加载不会等待SSH），
+    refresh=1 时同步刷新后返回。
+    """
+    try:
+        refreshing = False
+        if request.args.get('refresh') == '1':
+            if check_windows_status():
+                telemetry_cache.refresh()
+        elif not telemetry_cache.is_fresh() and not telemetry_cache.refresh_lock.locked():
+            refreshing = True
+            threading.Thread(target=refresh_telemetry_if_online, daemon=True).start()
+        
+        return jsonify(dict(telemetry_cache.snapshot(), refreshing=refreshing))
+    except Exception as e:
+        return jsonify({"telemetry": None, "error": str(e)}), 500
+
+@app.route('/wake_history', methods=['GET'])
+def wake_history():
+    """按主机返回开机耗时分位数及最近的唤醒记录"""
+    try:
+        limit = int(request.args.get('recent', 20))
+    except ValueError:
+        return jsonify({"error": "recent must be an integer"}), 400
+    limit = max(1, min(limit, WAKE_TRACE_RING_SIZE))
+    
+    try:
+        return jsonify({
+            "hosts": wake_traces.history(),
+            "recent": wake_traces.recent(limit)
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/wake_trace/<trace_id>', methods=['GET'])
+def wake_trace(trace_id):
+    """查询单次唤醒的追踪记录"""
+    trace = wake_traces.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace)
+
+# ===== 云端控制通道 =====
+try:
+    import websocket  # websocket-client，仅控制通道模式需要
+except ImportError:
+    websocket = None
+
+CONTROL_CHANNEL_URL = config.get('control_channel_url')  # 例如 "wss://wol.example.com/relay/channel"
+CONTROL_CHANNEL_SECRET = config.get('control_channel_secret')
+RELAY_ID = config.get('relay_id') or socket.gethostname()
+STATE_PUSH_INTERVAL = config.get('state_push_interval', 10)  # 探测间隔，状态变化时立即推送
+# 状态未变化时的心跳间隔，需小于云服务器认定推送状态过期的30秒
+STATE_HEARTBEAT_INTERVAL = config.get('state_heartbeat_interval', 25)
+RELAY_HTTP_ENABLED = config.get('relay_http_enabled', True)  # 仅使用控制通道时可关闭HTTP监听
+
+def sign_channel_message(*parts):
+    """控制通道握手签名: HMAC-SHA256(密钥, 各字段以换行连接)"""
+    message = '\n'.join(str(part) for part in parts).encode()
+    return hmac.new(CONTROL_CHANNEL_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+class ControlChannelClient:
+    """中继主动连接云服务器并保持的长连接（WebSocket）
+    
+    云服务器下发的命令按ID复用同一连接，交给本地Flask路由处理，
+    因此与HTTP模式的行为完全一致；Windows状态变化定期主动推送。
+    """
+    
+    def __init__(self, url):
+        self.url = url
+        self.ws = None
+        self.nonce = None
+        self.authenticated = False
+        self.last_state = None
+        self.last_push = 0
+        self.send_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='channel-cmd')
+    
+    def send(self, message):
+        with self.send_lock:
+            if self.ws is not None:
+                self.ws.send(json.dumps(message))
+    
+    def _handshake_headers(self):
+        timestamp = str(int(time.time()))
+        self.nonce = os.urandom(16).hex()
+        return [
+            f'X-Relay-Id: {RELAY_ID}',
+            f'X-Relay-Timestamp: {timestamp}',
+            f'X-Relay-Nonce: {self.nonce}',
+            f'X-Relay-Signature: {sign_channel_message(RELAY_ID, timestamp, self.nonce)}'
+        ]
+    
+    def _on_message(self, ws, raw):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            return
+        
+        if message.get('type') == 'hello':
+            # 云服务器需证明同样持有密钥，防止连接到伪造的服务端
+            expected = sign_channel_message('cloud', RELAY_ID, self.nonce)
+            if not hmac.compare_digest(message.get('signature', ''), expected):
+                print("Control channel: invalid server signature, closing")
+                ws.close()
+                return
+            self.authenticated = True
+            self.last_state = None
+            print(f"Control channel established: {self.url} as {RELAY_ID}")
+            self.executor.submit(self.push_state, True)
+        elif self.authenticated and message.get('type') == 'request':
+            self.executor.submit(self._handle_request, message)
+    
+    def _handle_request(self, message):
+        """把通道命令转交给本地路由处理"""
+        try:
+            client = app.test_client()
+            response = client.open(
+                message['path'],
+                method=message.get('method', 'GET'),
+                json=message.get('body'),
+                query_string=message.get('params'),
+                headers=message.get('headers')
+            )
+            reply = {"type": "response", "id": message['id'], "status": response.status_code,
+                     "body": response.get_json(silent=True)}
+        except Exception as e:
+            reply = {"type": "response", "id": message.get('id'), "status": 500,
+                     "body": {"success": False, "message": f"Server error: {str(e)}"}}
+        self.send(reply)
+    
+    def push_state(self, force=False):
+        """推送Windows主机状态：变化时立即推送，未变化时按心跳间隔推送"""
+        state = "online" if check_windows_status() else "offline"
+        now = time.time()
+        if force or state != self.last_state or now - self.last_push >= STATE_HEARTBEAT_INTERVAL:
+            self.last_state = state
+            self.last_push = now
+            self.send({"type": "state", "win_status": state, "ts": now})
+    
+    def _push_loop(self):
+        while True:
+            time.sleep(STATE_PUSH_INTERVAL)
+            if self.authenticated:
+                try:
+                    self.push_state()
+                except Exception as e:
+                    print(f"Control channel state push failed: {e}")
+    
+    def run_forever(self):
+        """保持连接，断线后指数退避重连"""
+        threading.Thread(target=self._push_loop, daemon=True).start()
+        backoff = 1
+        while True:
+            started = time.time()
+            self.ws = websocket.WebSocketApp(
+                self.url,
+                header=self._handshake_headers(),
+                on_message=self._on_message
+            )
+            self.ws.run_forever(ping_interval=20, ping_timeout=10)
+            self.ws = None
+            self.authenticated = False
+            
+            if time.time() - started > 60:
+                backoff = 1
+            print(f"Control channel disconnected, reconnecting in {backoff}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+def start_control_channel():
+    """配置了 control_channel_url 时在后台启动控制通道"""
+    if not CONTROL_CHANNEL_URL:
+        return None
+    if websocket is None:
+        print("Control channel requires websocket-client: pip3 install websocket-client")
+        return None
+    if not CONTROL_CHANNEL_SECRET:
+        print("Control channel requires control_channel_secret in config.json")
+        return None
+    
+    channel = ControlChannelClient(CONTROL_CHANNEL_URL)
+    threading.Thread(target=channel.run_forever, name='control-channel', daemon=True).start()
+    return channel
+
+# ===== 按需唤醒TCP代理 =====
+# 例如 [{"listen_port": 3389, "target_port": 3389}, {"listen_port": 2222, "target_port": 22}]
+WAKE_PROXY_PORTS = config.get('wake_proxy_ports', [])
+WAKE_PROXY_LISTEN = config.get('wake_proxy_listen', '::')
+# 允许连接代理的来源网段，默认只允许内网和本机；任何能连上代理端口的人都能唤醒主机
+WAKE_PROXY_ALLOWED_SOURCES = [
+    ipaddress.ip_network(cidr) for cidr in config.get('wake_proxy_allowed_sources', [
+        '127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '::1/128', 'fc00::/7', 'fe80::/10'
+    ])
+]
+WAKE_PROXY_TIMEOUT = config.get('wake_proxy_timeout', 120)  # 等待目标端口可用的最长时间（秒）
+WAKE_PROXY_MAX_CONNECTIONS = config.get('wake_proxy_max_connections', 64)
+WAKE_PROXY_REWAKE_INTERVAL = 30  # 所有代理端口共用，最多每30秒发一次唤醒包
+WINDOWS_MAC = config.get('windows_mac')  # 代理模式需要，由中继自行发送唤醒包
+SPLICE_CHUNK = 1 << 16
+
+_proxy_slots = threading.BoundedSemaphore(WAKE_PROXY_MAX_CONNECTIONS)
+_proxy_wake_lock = threading.Lock()
+_proxy_last_wake = 0.0
+
+def wake_for_proxy(target_port):
+    """代理收到连接但目标不可达时发送唤醒包（多个连接同时到达只发一次）"""
+    global _proxy_last_wake
+    with _proxy_wake_lock:
+        if time.time() - _proxy_last_wake < WAKE_PROXY_REWAKE_INTERVAL:
+            return
+        _proxy_last_wake = time.time()
+    
+    relay_receipt = time.time()
+    success, message, variants = send_magic_packet_burst(WINDOWS_MAC, WOL_SECUREON_PASSWORD)
+    print(f"Wake proxy :{target_port} -> {WINDOWS_MAC}: {message}")
+    if success:
+        start_wake_trace(os.urandom(8).hex(), WINDOWS_MAC, variants, {'relay_receipt': relay_receipt})
+
+def proxy_source_allowed(address):
+    """来源地址是否在允许的网段内（双栈监听时IPv4地址以 ::ffff:a.b.c.d 形式出现）"""
+    try:
+        ip = ipaddress.ip_address(address.split('%')[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return any(ip in network for network in WAKE_PROXY_ALLOWED_SOURCES)
+
+def _client_gone(client):
+    """客户端是否已断开（只窥探，不消费数据）"""
+    readable, _, _ = select.select([client], [], [], 0)
+    if not readable:
+        return False
+    try:
+        return client.recv(1, socket.MSG_PEEK) == b''
+    except OSError:
+        return True
+
+def connect_when_awake(client, target_port):
+    """连接目标端口；不可达时唤醒主机并保持客户端连接，直到端口可用或超时"""
+    deadline = time.time() + WAKE_PROXY_TIMEOUT
+    while True:
+        try:
+            upstream = socket.create_connection((WINDOWS_HOST_IP, target_port), timeout=1.0)
+            upstream.settimeout(None)
+            return upstream
+        except OSError:
+            pass
+        
+        if time.time() >= deadline or _client_gone(client):
+            return None
+        wake_for_proxy(target_port)
+        time.sleep(WAKE_PROBE_INTERVAL)
+
+def _pump_splice(src, dst):
+    """经管道用 splice(2) 在内核中转发，不复制到用户态"""
+    read_fd, write_fd = os.pipe()
+    try:
+        while True:
+            received = os.splice(src.fileno(), write_fd, SPLICE_CHUNK, flags=os.SPLICE_F_MOVE)
+            if received == 0:
+                return
+            while received:
+                received -= os.splice(read_fd, dst.fileno(), received, flags=os.SPLICE_F_MOVE)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def _pump_copy(src, dst):
+    """不支持 splice 时使用复用缓冲区转发"""
+    buffer = bytearray(SPLICE_CHUNK)
+    view = memoryview(buffer)
+    while True:
+        received = src.recv_into(buffer)
+        if received == 0:
+            return
+        dst.sendall(view[:received])
+
+def _pump(src, dst):
+    """单向转发，源端关闭后半关闭目标端"""
+    try:
+        if hasattr(os, 'splice'):
+            _pump_splice(src, dst)
+        else:
+            _pump_copy(src, dst)
+    except OSError:
+        pass
+    finally:
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+def handle_proxy_connection(client, address, target_port):
+    """处理一个代理连接：必要时唤醒主机，然后双向转发"""
+    upstream = None
+    try:
+        upstream = connect_when_awake(client, target_port)
+        if upstream is None:
+            print(f"Wake proxy :{target_port} gave up on {address[0]}")
+            return
+        
+        reverse = threading.Thread(target=_pump, args=(upstream, client), daemon=True)
+        reverse.start()
+        _pump(client, upstream)
+        reverse.join()
+    finally:
+        for sock in (client, upstream):
+            if sock is not None:
+                sock.close()
+        _proxy_slots.release()
+
+def run_wake_proxy(listen_port, target_port):
+    """监听一个代理端口（IPv6地址时为IPv4/IPv6双栈，也可只监听内网IPv4地址）"""
+    if ':' in WAKE_PROXY_LISTEN:
+        server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        server.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((WAKE_PROXY_LISTEN, listen_port))
+    server.listen(64)
+    print(f"Wake proxy listening on [{WAKE_PROXY_LISTEN}]:{listen_port} -> {WINDOWS_HOST_IP}:{target_port}")
+    
+    while True:
+        client, address = server.accept()
+        if not proxy_source_allowed(address[0]):
+            # 在连接目标或发送唤醒包之前拒绝，扫描器无法借此唤醒主机
+            print(f"Wake proxy :{listen_port} rejected {address[0]}")
+            client.close()
+            continue
+        if not _proxy_slots.acquire(blocking=False):
+            client.close()
+            continue
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(
+            target=handle_proxy_connection, args=(client, address, target_port), daemon=True
+        ).start()
+
+def start_wake_proxies():
+    """按配置启动所有代理端口"""
+    if not WAKE_PROXY_PORTS:
+        return
+    if not WINDOWS_MAC:
+        print("Wake proxy requires windows_mac in config.json")
+        return
+    for entry in WAKE_PROXY_PORTS:
+        threading.Thread(
+            target=run_wake_proxy,
+            args=(entry['listen_port'], entry.get('target_port', entry['listen_port'])),
+            name=f"wake-proxy-{entry['listen_port']}",
+            daemon=True
+        ).start()
+
 if __name__ == '__main__':
-    # 在IPv6地址上监听
-    app.run(host='::', port=5000, debug=False)
+    channel = start_control_channel()
+    start_wake_proxies()
+    
+    if RELAY_HTTP_ENABLED:
+        # 在IPv6地址上监听
+        app.run(host='::', port=5000, debug=False)
+    elif channel is None and not WAKE_PROXY_PORTS:
+        print("relay_http_enabled is false but the control channel is not configured")
+        sys.exit(1)
+    else:
+        # 仅通过控制通道工作，无需开放入站端口
+        while True:
+            time.sleep(3600)
@@ -0,0 +1,47 @@
+"""测试辅助：在临时目录中加载云服务器模块"""
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOUD_SERVER_PATH = os.path.join(REPO_ROOT, 'cloud', 'cloud_server_production_optimized.py')
+
+TEST_CONFIG = {
+    "ubuntu_server_host": "127.0.0.1",
+    "ubuntu_port": 9,
+    "windows_mac": "AA:BB:CC:DD:EE:FF",
+    "bypass_domain": "localhost",
+    "relay_health_interval": 3600
+}
+
+_cloud_server = None
+
+def load_cloud_server():
+    """加载云服务器模块；配置、日志和数据库都写在临时目录，整个测试进程只加载一次"""
+    global _cloud_server
+    if _cloud_server is not None:
+        return _cloud_server
+
+    workdir = tempfile.mkdtemp(prefix='wol-test-')
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(TEST_CONFIG, credentials_db=os.path.join(workdir, 'user_credentials.db')), f)
+
+    spec = importlib.util.spec_from_file_location('cloud_server', CLOUD_SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # 模块按 __file__ 所在目录查找 config.json
+    module.__file__ = os.path.join(workdir, 'cloud_server.py')
+    sys.modules['cloud_server'] = module
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+
+    logging.disable(logging.CRITICAL)
+    _cloud_server = module
+    return module
@@ -0,0 +1,75 @@
+"""滑动窗口限流测试"""
+import time
+import unittest
+
+from helpers import load_cloud_server
+
+class SlidingWindowLimiterTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def test_limit_within_window(self):
+        limiter = self.server.SlidingWindowLimiter()
+        results = [limiter.hit('k', 3, 60)[0] for _ in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+        allowed, retry_after = limiter.hit('k', 3, 60)
+        self.assertFalse(allowed)
+        self.assertGreaterEqual(retry_after, 1)
+
+    def test_eviction_is_bounded(self):
+        limiter = self.server.SlidingWindowLimiter(max_keys=100)
+        for i in range(1000):
+            limiter.hit(f'key-{i}', 5, 60)
+        self.assertEqual(len(limiter._windows), 100)
+        # 最近访问的键保留，最早的被淘汰
+        self.assertIn('key-999', limiter._windows)
+        self.assertNotIn('key-0', limiter._windows)
+
+    def test_recently_used_key_survives_eviction(self):
+        limiter = self.server.SlidingWindowLimiter(max_keys=3)
+        for key in ('a', 'b', 'c'):
+            limiter.hit(key, 5, 60)
+        limiter.hit('a', 5, 60)
+        limiter.hit('d', 5, 60)
+        self.assertEqual(list(limiter._windows), ['c', 'a', 'd'])
+
+    def test_eviction_cost_does_not_grow(self):
+        limiter = self.server.SlidingWindowLimiter(max_keys=1000)
+        for i in range(1000):
+            limiter.hit(f'warm-{i}', 5, 60)
+        started = time.perf_counter()
+        for i in range(20000):
+            limiter.hit(f'flood-{i}', 5, 60)
+        self.assertLess(time.perf_counter() - started, 2.0)
+
+class RateLimitSubjectTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def test_ipv6_grouped_by_64(self):
+        subject = self.server.rate_limit_subject
+        self.assertEqual(subject('2001:db8:1:2::1'), subject('2001:db8:1:2:ffff:ffff:ffff:ffff'))
+        self.assertEqual(subject('2001:db8:1:2::1'), '2001:db8:1:2::/64')
+        self.assertNotEqual(subject('2001:db8:1:2::1'), subject('2001:db8:1:3::1'))
+
+    def test_ipv4_and_mapped_addresses(self):
+        subject = self.server.rate_limit_subject
+        self.assertEqual(subject('203.0.113.7'), '203.0.113.7')
+        self.assertEqual(subject('::ffff:203.0.113.7'), '203.0.113.7')
+        self.assertNotEqual(subject('203.0.113.7'), subject('203.0.113.8'))
+
+    def test_rotating_ipv6_addresses_hit_the_same_bucket(self):
+        self.server.rate_limiter = self.server.SlidingWindowLimiter()
+        client = self.server.app.test_client()
+        codes = [
+            client.post('/check_ip_bypass', json={}, environ_base={'REMOTE_ADDR': f'2001:db8:5:6::{i:x}'}).status_code
+            for i in range(1, 13)
+        ]
+        self.assertEqual(codes.count(429), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""注册接口的权限测试：已有凭据的用户添加设备需先登录"""
+import base64
+import secrets
+import unittest
+from datetime import datetime
+
+from helpers import load_cloud_server
+from test_webauthn import FakeAuthenticator
+
+BASE_URL = 'https://localhost'
+
+class RegistrationTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def setUp(self):
+        self.client = self.server.app.test_client()
+        self.server.rate_limiter = self.server.SlidingWindowLimiter()
+        self.username = f"user-{secrets.token_hex(4)}"
+
+    def register(self, authenticator):
+        """完整走一遍注册流程，返回 (begin响应, complete响应)"""
+        begin = self.client.post('/register/begin', json={'username': self.username}, base_url=BASE_URL)
+        if begin.status_code != 200:
+            return begin, None
+        challenge = base64.urlsafe_b64decode(begin.json['challenge'] + '==')
+        complete = self.client.post('/register/complete', base_url=BASE_URL, json={
+            'username': self.username, 'credential': authenticator.register(challenge)
+        })
+        return begin, complete
+
+    def login(self, username):
+        with self.client.session_transaction(base_url=BASE_URL) as session:
+            session['biometric_authenticated'] = True
+            session['username'] = username
+            session['auth_time'] = datetime.now().isoformat()
+
+    def test_first_credential_needs_no_session(self):
+        begin, complete = self.register(FakeAuthenticator(-7))
+        self.assertEqual(begin.json['authenticatorSelection'].get('authenticatorAttachment'), 'platform')
+        self.assertEqual(complete.status_code, 200)
+        self.assertTrue(self.server.credential_store.has_user(self.username))
+
+    def test_existing_user_requires_session(self):
+        self.register(FakeAuthenticator(-7))
+        begin, _ = self.register(FakeAuthenticator(-7))
+        self.assertEqual(begin.status_code, 403)
+        self.assertEqual(len(self.server.credential_store.get_user_credentials(self.username)), 1)
+
+    def test_other_users_session_is_not_enough(self):
+        self.register(FakeAuthenticator(-7))
+        self.login('someone-else')
+        begin, _ = self.register(FakeAuthenticator(-7))
+        self.assertEqual(begin.status_code, 403)
+
+    def test_logged_in_user_can_add_device(self):
+        self.register(FakeAuthenticator(-7))
+        self.login(self.username)
+        begin, complete = self.register(FakeAuthenticator(-257))
+        self.assertEqual(begin.status_code, 200)
+        self.assertNotIn('authenticatorAttachment', begin.json['authenticatorSelection'])
+        self.assertEqual(complete.status_code, 200)
+        self.assertEqual(len(self.server.credential_store.get_user_credentials(self.username)), 2)
+
+    def test_complete_rechecks_after_concurrent_first_registration(self):
+        begin = self.client.post('/register/begin', json={'username': self.username}, base_url=BASE_URL)
+        challenge = base64.urlsafe_b64decode(begin.json['challenge'] + '==')
+        # 另一个客户端在此期间完成了首次注册
+        other = FakeAuthenticator(-7)
+        self.server.credential_store.add_credential(self.username, {'id': other.id, 'rawId': other.id})
+        complete = self.client.post('/register/complete', base_url=BASE_URL, json={
+            'username': self.username, 'credential': FakeAuthenticator(-7).register(challenge)
+        })
+        self.assertEqual(complete.status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
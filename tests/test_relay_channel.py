@@ -0,0 +1,97 @@
+"""中继控制通道握手测试"""
+import os
+import time
+import unittest
+
+from helpers import load_cloud_server
+
+class RelayHandshakeTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def setUp(self):
+        self.saved = (self.server._channel_relays, self.server.RELAY_CHANNEL_SECRETS, self.server.RELAY_CHANNEL_SECRET)
+
+    def tearDown(self):
+        self.server._channel_relays, self.server.RELAY_CHANNEL_SECRETS, self.server.RELAY_CHANNEL_SECRET = self.saved
+
+    def configure(self, relays, global_secret=None):
+        self.server._channel_relays = relays
+        self.server.RELAY_CHANNEL_SECRETS = {name: r['secret'] for name, r in relays.items() if r.get('secret')}
+        self.server.RELAY_CHANNEL_SECRET = global_secret
+
+    def handshake(self, relay_id, secret, timestamp=None, nonce=None):
+        timestamp = str(int(timestamp or time.time()))
+        nonce = nonce or os.urandom(16).hex()
+        return {
+            'X-Relay-Id': relay_id,
+            'X-Relay-Timestamp': timestamp,
+            'X-Relay-Nonce': nonce,
+            'X-Relay-Signature': self.server.sign_channel_message(secret, relay_id, timestamp, nonce)
+        }
+
+    def test_relay_signs_with_its_own_secret(self):
+        self.configure({'home': {'secret': 'home-key'}, 'office': {'secret': 'office-key'}})
+        self.assertEqual(self.server.verify_relay_handshake(self.handshake('home', 'home-key')), 'home')
+        self.assertEqual(self.server.verify_relay_handshake(self.handshake('office', 'office-key')), 'office')
+
+    def test_relay_cannot_claim_another_relay_id(self):
+        self.configure({'home': {'secret': 'home-key'}, 'office': {'secret': 'office-key'}})
+        self.assertIsNone(self.server.verify_relay_handshake(self.handshake('office', 'home-key')))
+
+    def test_global_secret_rejected_with_several_relays(self):
+        self.configure({'home': {'secret': 'home-key'}, 'office': {}}, global_secret='shared')
+        self.assertIsNone(self.server.verify_relay_handshake(self.handshake('office', 'shared')))
+        self.assertIsNone(self.server.verify_relay_handshake(self.handshake('unknown', 'shared')))
+
+    def test_global_secret_for_single_relay(self):
+        self.configure({'default': {}}, global_secret='shared')
+        self.assertEqual(self.server.verify_relay_handshake(self.handshake('home', 'shared')), 'home')
+
+    def test_replayed_nonce_and_stale_timestamp(self):
+        self.configure({'home': {'secret': 'home-key'}})
+        headers = self.handshake('home', 'home-key')
+        self.assertEqual(self.server.verify_relay_handshake(headers), 'home')
+        self.assertIsNone(self.server.verify_relay_handshake(headers))
+        self.assertIsNone(self.server.verify_relay_handshake(self.handshake('home', 'home-key', time.time() - 3600)))
+
+class RelayAvailabilityTests(unittest.TestCase):
+    """控制通道在线时，可用性仍以最近的检查结果为准"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def setUp(self):
+        self.registry = self.server.RelayRegistry({
+            'relays': {'home': {'host': '127.0.0.1', 'port': 9}, 'cloud-only': {}},
+            'hosts': {'home': {'mac': 'AA:BB:CC:DD:EE:FF', 'relays': ['home']},
+                      'office': {'mac': 'AA:BB:CC:DD:EE:00', 'relays': ['cloud-only']}}
+        })
+
+    def test_half_open_channel_is_unavailable_after_failure(self):
+        self.registry.mark_connected('home')
+        self.assertTrue(self.registry.is_available('home'))
+        time.sleep(0.01)
+        self.registry.record('home', False, error='timeout')
+        self.assertFalse(self.registry.is_available('home'))
+
+    def test_reconnect_restores_availability(self):
+        self.registry.record('home', False, error='timeout')
+        time.sleep(0.01)
+        self.registry.mark_connected('home')
+        self.assertTrue(self.registry.is_available('home'))
+
+    def test_disconnect_marks_channel_only_relay_unavailable(self):
+        self.registry.mark_connected('cloud-only')
+        time.sleep(0.01)
+        self.registry.mark_disconnected('cloud-only')
+        self.assertFalse(self.registry.is_available('cloud-only'))
+        # 有直连地址的中继断开通道后仍可走HTTP
+        self.registry.mark_disconnected('home')
+        self.assertTrue(self.registry.is_available('home'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+"""WebAuthn 注册/断言校验测试（ES256 与 RS256）"""
+import base64
+import hashlib
+import json
+import os
+import secrets
+import unittest
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+from helpers import load_cloud_server
+
+RP_ID = 'wol.gofoyi.shop'
+ORIGIN = f'https://{RP_ID}'
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+def cbor_encode(value):
+    """测试用的最小CBOR编码（整数、字节串、字符串、数组、映射）"""
+    def head(major, length):
+        if length < 24:
+            return bytes([major << 5 | length])
+        for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+            if length < 1 << (8 * size):
+                return bytes([major << 5 | info]) + length.to_bytes(size, 'big')
+        raise ValueError(length)
+
+    if isinstance(value, int):
+        return head(0, value) if value >= 0 else head(1, -1 - value)
+    if isinstance(value, bytes):
+        return head(2, len(value)) + value
+    if isinstance(value, str):
+        encoded = value.encode('utf-8')
+        return head(3, len(encoded)) + encoded
+    if isinstance(value, list):
+        return head(4, len(value)) + b''.join(cbor_encode(item) for item in value)
+    if isinstance(value, dict):
+        return head(5, len(value)) + b''.join(cbor_encode(k) + cbor_encode(v) for k, v in value.items())
+    raise TypeError(type(value))
+
+class FakeAuthenticator:
+    """生成注册和断言响应的软件认证器"""
+
+    def __init__(self, alg):
+        self.alg = alg
+        self.credential_id = os.urandom(16)
+        if alg == -7:
+            self.private_key = ec.generate_private_key(ec.SECP256R1())
+            numbers = self.private_key.public_key().public_numbers()
+            self.cose_key = {1: 2, 3: -7, -1: 1, -2: numbers.x.to_bytes(32, 'big'), -3: numbers.y.to_bytes(32, 'big')}
+        else:
+            self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            numbers = self.private_key.public_key().public_numbers()
+            self.cose_key = {1: 3, 3: -257, -1: numbers.n.to_bytes(256, 'big'), -2: numbers.e.to_bytes(3, 'big')}
+
+    @property
+    def id(self):
+        return b64url(self.credential_id)
+
+    @staticmethod
+    def client_data(kind, challenge, origin=ORIGIN):
+        return json.dumps({"type": kind, "challenge": b64url(challenge), "origin": origin}).encode()
+
+    def auth_data(self, sign_count, flags=0x05, rp_id=RP_ID, attested=False):
+        data = hashlib.sha256(rp_id.encode()).digest() + bytes([flags]) + sign_count.to_bytes(4, 'big')
+        if attested:
+            data += bytes(16) + len(self.credential_id).to_bytes(2, 'big') + self.credential_id + cbor_encode(self.cose_key)
+        return data
+
+    def sign(self, data):
+        if self.alg == -7:
+            return self.private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+        return self.private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+    def register(self, challenge, auth_data=None):
+        if auth_data is None:
+            auth_data = self.auth_data(0, flags=0x45, attested=True)
+        attestation = cbor_encode({"fmt": "none", "attStmt": {}, "authData": auth_data})
+        return {
+            "id": self.id,
+            "rawId": self.id,
+            "type": "public-key",
+            "response": {
+                "clientDataJSON": b64url(self.client_data('webauthn.create', challenge)),
+                "attestationObject": b64url(attestation)
+            }
+        }
+
+    def assert_(self, challenge, sign_count=1, flags=0x05, rp_id=RP_ID, origin=ORIGIN, auth_data=None):
+        client_data = self.client_data('webauthn.get', challenge, origin)
+        if auth_data is None:
+            auth_data = self.auth_data(sign_count, flags, rp_id)
+        signature = self.sign(auth_data + hashlib.sha256(client_data).digest())
+        return {
+            "id": self.id,
+            "rawId": self.id,
+            "type": "public-key",
+            "response": {
+                "clientDataJSON": b64url(client_data),
+                "authenticatorData": b64url(auth_data),
+                "signature": b64url(signature)
+            }
+        }
+
+class WebAuthnVerificationTests:
+    """ES256/RS256 共用的用例，子类指定 ALG"""
+    ALG = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def setUp(self):
+        self.authenticator = FakeAuthenticator(self.ALG)
+        self.challenge = secrets.token_bytes(32)
+        key_material = self.server.verify_registration(
+            self.authenticator.register(self.challenge), self.challenge, RP_ID
+        )
+        self.stored = {'id': key_material['credential_id'], 'public_key': key_material['public_key'],
+                       'alg': key_material['alg'], 'sign_count': key_material['sign_count']}
+
+    def verify(self, credential, challenge=None, stored=None):
+        return self.server.verify_assertion(credential, stored or self.stored, challenge or self.challenge, RP_ID)
+
+    def assertRejected(self, credential, **kwargs):
+        with self.assertRaises(self.server.WebAuthnError):
+            self.verify(credential, **kwargs)
+
+    def test_registration_extracts_key(self):
+        self.assertEqual(self.stored['id'], self.authenticator.id)
+        self.assertEqual(self.stored['alg'], self.ALG)
+
+    def test_valid_assertion(self):
+        self.assertEqual(self.verify(self.authenticator.assert_(self.challenge, sign_count=7)), 7)
+
+    def test_wrong_challenge(self):
+        self.assertRejected(self.authenticator.assert_(secrets.token_bytes(32)))
+
+    def test_wrong_origin(self):
+        self.assertRejected(self.authenticator.assert_(self.challenge, origin='https://evil.example.com'))
+        self.assertRejected(self.authenticator.assert_(self.challenge, origin=f'http://{RP_ID}'))
+
+    def test_wrong_rp_id_hash(self):
+        self.assertRejected(self.authenticator.assert_(self.challenge, rp_id='evil.example.com'))
+
+    def test_missing_user_presence(self):
+        self.assertRejected(self.authenticator.assert_(self.challenge, flags=0x04))
+
+    def test_bad_signature(self):
+        credential = self.authenticator.assert_(self.challenge)
+        other = FakeAuthenticator(self.ALG).assert_(self.challenge)
+        credential['response']['signature'] = other['response']['signature']
+        self.assertRejected(credential)
+
+    def test_counter_not_increasing(self):
+        stored = dict(self.stored, sign_count=5)
+        self.assertRejected(self.authenticator.assert_(self.challenge, sign_count=5), stored=stored)
+        self.assertRejected(self.authenticator.assert_(self.challenge, sign_count=3), stored=stored)
+        self.assertEqual(self.verify(self.authenticator.assert_(self.challenge, sign_count=6), stored=stored), 6)
+
+    def test_truncated_auth_data(self):
+        full = self.authenticator.auth_data(1)
+        self.assertRejected(self.authenticator.assert_(self.challenge, auth_data=full[:30]))
+        # 声明携带凭据数据（AT标志）但实际被截断
+        attested = self.authenticator.auth_data(1, flags=0x45, attested=True)
+        for length in (40, 54, 60, len(attested) - 5):
+            self.assertRejected(self.authenticator.assert_(self.challenge, auth_data=attested[:length]))
+
+    def test_truncated_registration(self):
+        attested = self.authenticator.auth_data(0, flags=0x45, attested=True)
+        for length in (20, 40, 54, 60, len(attested) - 5):
+            with self.assertRaises(self.server.WebAuthnError):
+                self.server.verify_registration(
+                    self.authenticator.register(self.challenge, auth_data=attested[:length]), self.challenge, RP_ID
+                )
+
+    def test_registration_rejects_mismatched_id(self):
+        victim_id = b64url(os.urandom(16))
+        for field in ('id', 'rawId'):
+            credential = self.authenticator.register(self.challenge)
+            credential[field] = victim_id
+            with self.assertRaises(self.server.WebAuthnError):
+                self.server.verify_registration(credential, self.challenge, RP_ID)
+        self.assertNotIn(victim_id, self.server._public_key_cache)
+
+    def test_registration_does_not_fill_key_cache(self):
+        authenticator = FakeAuthenticator(self.ALG)
+        self.server.verify_registration(authenticator.register(self.challenge), self.challenge, RP_ID)
+        self.assertNotIn(authenticator.id, self.server._public_key_cache)
+
+class ES256Tests(WebAuthnVerificationTests, unittest.TestCase):
+    ALG = -7
+
+class RS256Tests(WebAuthnVerificationTests, unittest.TestCase):
+    ALG = -257
+
+class AuthenticateRouteTests(unittest.TestCase):
+    """经路由提交的畸形数据返回400而不是500"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = load_cloud_server()
+
+    def setUp(self):
+        self.client = self.server.app.test_client()
+        self.server.rate_limiter = self.server.SlidingWindowLimiter()
+        self.username = f"user-{secrets.token_hex(4)}"
+        self.authenticator = FakeAuthenticator(-7)
+        challenge = secrets.token_bytes(32)
+        key_material = self.server.verify_registration(self.authenticator.register(challenge), challenge, RP_ID)
+        self.server.credential_store.add_credential(self.username, {
+            'id': key_material['credential_id'], 'rawId': key_material['credential_id'],
+            'public_key': key_material['public_key'], 'alg': key_material['alg'], 'sign_count': 0
+        })
+
+    def begin(self):
+        response = self.client.post('/authenticate/begin', json={'username': self.username})
+        self.assertEqual(response.status_code, 200)
+        return base64.urlsafe_b64decode(response.json['challenge'] + '==')
+
+    def complete(self, credential):
+        return self.client.post('/authenticate/complete', json={'username': self.username, 'credential': credential})
+
+    def test_valid_assertion_logs_in(self):
+        response = self.complete(self.authenticator.assert_(self.begin()))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['success'])
+
+    def test_truncated_auth_data_returns_400(self):
+        attested = self.authenticator.auth_data(1, flags=0x45, attested=True)
+        response = self.complete(self.authenticator.assert_(self.begin(), auth_data=attested[:60]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_register_with_foreign_id_does_not_poison_cache(self):
+        # 攻击者以受害者的凭据ID注册自己的认证器
+        attacker = FakeAuthenticator(-7)
+        challenge = secrets.token_bytes(32)
+        self.server.CHALLENGES['attacker'] = {'challenge': challenge, 'timestamp': self.server.datetime.now()}
+        credential = attacker.register(challenge)
+        credential['id'] = self.authenticator.id
+        response = self.client.post('/register/complete', json={'username': 'attacker', 'credential': credential})
+        self.assertEqual(response.status_code, 400)
+
+        # 攻击者的签名不能通过受害者凭据的认证
+        forged = attacker.assert_(self.begin())
+        forged['id'] = forged['rawId'] = self.authenticator.id
+        self.assertEqual(self.complete(forged).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()